@@ -7,8 +7,10 @@ import os
 
 import requests
 import argparse
+import time
 import openpyxl
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 from huaweicloudsdkcore.auth.credentials import BasicCredentials
@@ -50,6 +52,8 @@ class GlobalConfig(object):
     }
     need_delete_sheet_name = "Sheet"
     eip_v2_zone = ["cn-south-4", ]
+    eip_page_limit = 500
+    device_page_limit = 500
 
 
 class EndPoint(object):
@@ -96,9 +100,12 @@ class BaseInstance(object):
     def set_req_method(self):
         pass
 
+    def get_items(self, response_dict):
+        return response_dict[self.ret_filed]
+
     def parse_response_data(self, response_dict):
         dict_data = dict()
-        for item in response_dict[self.ret_filed]:
+        for item in self.get_items(response_dict):
             dict_data[item["id"]] = {
                 "name": item["name"],
                 "instance_type": self.instance_name
@@ -112,6 +119,47 @@ class BaseInstance(object):
         ret = show_infos_method(show_infos_req)
         return ret.to_dict()
 
+    def next_page(self, response_dict, item_list, limit, page_kwargs):
+        """
+        The marker style, the marker of the next page is the id of the last item
+        :return: dict, the kwargs of the next page besides the limit, None if it is the last page
+        """
+        if len(item_list) < limit:
+            return None
+        return {"marker": item_list[-1]["id"]}
+
+    def iter_pages(self, limit):
+        """
+        Follow the next page one by one and yield the response as soon as it arrives,
+        the count of page and the cost are recorded and printed at the end
+        :param limit: int, the size of one page, not more than the max limit of the service
+        :return: generator, the response dict of every page
+        """
+        limit = min(limit, getattr(self, "max_limit", limit))
+        page_kwargs = dict()
+        self.page_count, self.item_count, self.page_cost = 0, 0, list()
+        while page_kwargs is not None:
+            start_time = time.time()
+            response_dict = self.show_infos(limit=limit, **page_kwargs)
+            self.page_cost.append(time.time() - start_time)
+            item_list = self.get_items(response_dict) or list()
+            self.page_count += 1
+            self.item_count += len(item_list)
+            yield response_dict
+            page_kwargs = self.next_page(response_dict, item_list, limit, page_kwargs) if item_list else None
+        print("query {}: the count of page:{}, the count of item:{}, cost:{:.2f}s, the max cost of page:{:.2f}s".format(
+            getattr(self, "instance_name", self.__class__.__name__), self.page_count, self.item_count,
+            sum(self.page_cost), max(self.page_cost)))
+
+    def iter_infos(self, limit):
+        """
+        :param limit: int, the size of one page
+        :return: generator, the item of every page
+        """
+        for response_dict in self.iter_pages(limit):
+            for item in self.get_items(response_dict) or list():
+                yield item
+
 
 class EipInstanceV2(BaseInstance):
     def __init__(self, *args, **kwargs):
@@ -120,7 +168,7 @@ class EipInstanceV2(BaseInstance):
     def set_req_method(self):
         return ListPublicipsRequestV2, "list_publicips"
 
-    def parse_response_data(self, response_dict):
+    def get_items(self, response_dict):
         return response_dict['publicips']
 
 
@@ -131,9 +179,15 @@ class EipInstanceV3(BaseInstance):
     def set_req_method(self):
         return ListPublicipsRequestV3, "list_publicips"
 
-    def parse_response_data(self, response_dict):
+    def get_items(self, response_dict):
         return response_dict['publicips']
 
+    def next_page(self, response_dict, item_list, limit, page_kwargs):
+        page_info = response_dict.get("page_info") or dict()
+        if not page_info.get("next_marker"):
+            return None
+        return {"marker": page_info["next_marker"]}
+
 
 class NatInstance(BaseInstance):
     def __init__(self, *args, **kwargs):
@@ -161,6 +215,12 @@ class BMSInstance(BaseInstance):
         self.instance_name = "裸金属服务器"
         self.ret_filed = "servers"
 
+    def next_page(self, response_dict, item_list, limit, page_kwargs):
+        # the offset of bms is the page number, starting from 1
+        if len(item_list) < limit:
+            return None
+        return {"offset": page_kwargs.get("offset", 1) + 1}
+
     def set_req_method(self):
         return ListBareMetalServersRequest, "list_bare_metal_servers"
 
@@ -180,10 +240,18 @@ class RdsInstance(BaseInstance):
         super(RdsInstance, self).__init__(*args, **kwargs)
         self.instance_name = "云数据库 RDS"
         self.ret_filed = "instances"
+        self.max_limit = 100
 
     def set_req_method(self):
         return ListInstancesRequest, "list_instances"
 
+    def next_page(self, response_dict, item_list, limit, page_kwargs):
+        # the offset of rds is the index of the first item
+        offset = page_kwargs.get("offset", 0) + len(item_list)
+        if len(item_list) < limit or offset >= (response_dict.get("total_count") or 0):
+            return None
+        return {"offset": offset}
+
 
 class EipTools(object):
     def __init__(self, *args, **kwargs):
@@ -215,12 +283,23 @@ class EipTools(object):
         work_book.save(GlobalConfig.excel_path)
 
     @classmethod
-    def get_device_info(cls, instance_list):
+    def query_device_info(cls, instance_temp):
+        device_info = dict()
+        for instance_info in instance_temp.iter_pages(GlobalConfig.device_page_limit):
+            device_info.update(instance_temp.parse_response_data(instance_info))
+        return device_info
+
+    @classmethod
+    def get_device_info(cls, instance_list, executor):
+        """
+        Query the device list of every service concurrently, so one zone costs the slowest service, not the sum,
+        the devices are merged in the order of instance_list, the first one wins
+        :return: dict, {device_id: {"name": name, "instance_type": instance_type}}
+        """
         ret_dict = dict()
-        for instance_temp in instance_list:
-            instance_info = instance_temp.show_infos()
-            device_info = instance_temp.parse_response_data(instance_info)
-            for key, value in device_info.items():
+        all_task = [executor.submit(cls.query_device_info, instance_temp) for instance_temp in instance_list]
+        for task in all_task:
+            for key, value in task.result().items():
                 if key not in ret_dict.keys():
                     ret_dict[key] = value
         return ret_dict
@@ -327,9 +406,13 @@ def main():
     ecs_instance = EcsInstance(EcsClient, config, credentials, EndPoint.ecs_endpoint.format(zone))
     rds_instance = RdsInstance(RdsClient, config, credentials, EndPoint.rds_endpoint.format(zone))
     query_device_lists = [nat_instance, elb_instance, bms_instance, ecs_instance, rds_instance]
-    device_info_dict = eip_tools.get_device_info(query_device_lists)
-    eip_dict = eip_instance.show_infos()
-    eip_list = eip_instance.parse_response_data(eip_dict)
+    # the eip v2 zone does not map the eip to the device, only the eip list is needed
+    if zone in GlobalConfig.eip_v2_zone:
+        query_device_lists = list()
+    with ThreadPoolExecutor(max_workers=len(query_device_lists) + 1) as executor:
+        eip_task = executor.submit(list, eip_instance.iter_infos(GlobalConfig.eip_page_limit))
+        device_info_dict = eip_tools.get_device_info(query_device_lists, executor)
+        eip_list = eip_task.result()
     print("##################2.start to deal with data################")
     if zone in GlobalConfig.eip_v2_zone:
         result_list = eip_tools.parse_ips_v2(eip_list)
@@ -4,14 +4,18 @@
 # @FileName: collect_elastic_public_ip_by_yaml.py
 # @Software: PyCharm
 import os
+import csv
+import json
 
 import requests
 import argparse
 import time
 import openpyxl
 import yaml
+import threading
 from abc import abstractmethod
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
 
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 from huaweicloudsdkcore.auth.credentials import BasicCredentials
@@ -27,16 +31,31 @@ from huaweicloudsdkbms.v1 import BmsClient, ListBareMetalServersRequest
 from huaweicloudsdkecs.v2 import EcsClient, NovaListServersDetailsRequest
 from huaweicloudsdkrds.v3 import RdsClient, ListInstancesRequest
 
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 
 # noinspection DuplicatedCode
 class GlobalConfig(object):
     base_path = os.path.dirname(__file__)
-    excel_path = os.path.join(base_path, "公网IP统计表.xlsx")
+    # the excel is written once from scratch, so it does not share 公网IP统计表.xlsx of collect_elastic_public_ip.py,
+    # which adds the sheet of every zone to the existing workbook
+    excel_path = os.path.join(base_path, "公网IP账户统计表.xlsx")
     config_path = os.path.join(base_path, "collect_elastic_public_ip.yaml")
     excel_title = ["弹性公网IP", "IPv6地址", "弹性公网IP ID", "状态", "类型", "带宽名称", "带宽ID", "带宽大小(Mbit/s)",
                    "实例类型", "实例名称", "实例ID", "实例归属区域", "创建时间"]
+    # the columns of the csv and parquet, the same order as excel_title with the account first
+    column_title = ["account", "public_ip_address", "public_ipv6_address", "eip_id", "status", "type",
+                    "bandwidth_name", "bandwidth_id", "bandwidth_size", "instance_type", "instance_name",
+                    "instance_id", "zone", "create_time"]
+    csv_path = os.path.join(base_path, "公网IP统计表.csv")
+    parquet_path = os.path.join(base_path, "公网IP统计表.parquet")
+    output_format_list = ["excel", "csv", "parquet"]
     zone_alias_dict = {
         "cn-north-1": "华北-北京一",
         "cn-north-4": "华北-北京四",
@@ -58,8 +77,19 @@ class GlobalConfig(object):
         "la-south-2": "拉美-圣地亚哥",
         "ru-northwest-2": "俄罗斯-莫斯科二",
     }
-    need_delete_sheet_name = "Sheet"
     eip_v2_zone = ["cn-south-4", ]
+    eip_page_limit = 500
+    device_page_limit = 500
+    device_cache_path = os.path.join(base_path, "device_index_cache.json")
+    device_cache_ttl = 24 * 3600
+    device_service_list = ["nat", "elb", "bms", "ecs", "rds"]
+    # the services may own the device of the eip without vnic, the others may be any of the services
+    associate_service_dict = {
+        "NATGW": ["nat"],
+        "ELB": ["elb"],
+        "ELBV1": ["elb"],
+    }
+    zone_worker = 8
 
 
 # noinspection DuplicatedCode
@@ -110,6 +140,106 @@ def func_retry(tries=3, delay=1):
     return deco_retry
 
 
+class ExcelWriter(object):
+    """Collect all sheets of one run and write them once with the write-only(streaming) workbook of openpyxl"""
+
+    def __init__(self, path):
+        self.path = path
+        self.sheet_dict = dict()
+
+    def add_sheet(self, sheet_name, title, row_iter):
+        self.sheet_dict[sheet_name] = (title, row_iter)
+
+    def save(self):
+        work_book = openpyxl.Workbook(write_only=True)
+        for sheet_name, (title, row_iter) in self.sheet_dict.items():
+            table = work_book.create_sheet(sheet_name)
+            table.append(title)
+            for row in row_iter:
+                table.append(row)
+        work_book.save(self.path)
+
+
+class CsvWriter(object):
+    """Write the rows of every account to the csv as soon as they are collected"""
+
+    def __init__(self, path):
+        self.path = path
+        # utf-8-sig, so that excel opens the chinese content of the csv correctly
+        self.file = open(path, "w", newline="", encoding="utf-8-sig")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(GlobalConfig.column_title)
+
+    def add_rows(self, account, row_list):
+        for row in row_list:
+            self.writer.writerow([account] + row)
+
+    def save(self):
+        self.file.close()
+
+
+class ParquetWriter(object):
+    """Build the columns directly from the rows of every account, and write them to the parquet once"""
+
+    def __init__(self, path):
+        if pyarrow is None:
+            raise Exception("pyarrow is required by the parquet output, please run: pip3 install pyarrow")
+        self.path = path
+        self.column_dict = {column: list() for column in GlobalConfig.column_title}
+
+    def add_rows(self, account, row_list):
+        self.column_dict[GlobalConfig.column_title[0]].extend([account] * len(row_list))
+        for index, column in enumerate(GlobalConfig.column_title[1:]):
+            self.column_dict[column].extend(row[index] for row in row_list)
+
+    def save(self):
+        pyarrow.parquet.write_table(pyarrow.table(self.column_dict), self.path)
+
+
+class DeviceCache(object):
+    """
+    The device index of every service of every project persisted across runs,
+    each service expires on its own after the ttl, it is loaded once and saved once in one run
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.cache_dict = self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return dict()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print("load device cache:{} failed, err:{}".format(self.path, e))
+            return dict()
+
+    def save(self):
+        with self.lock:
+            content = json.dumps(self.cache_dict)
+        temp_path = "{}.tmp".format(self.path)
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(temp_path, self.path)
+
+    def get(self, project_id, service):
+        """:return: dict, the device index of the service, None if it is missing or expired"""
+        with self.lock:
+            cache_item = self.cache_dict.get(project_id, dict()).get(service)
+        if cache_item is None or time.time() - cache_item["update_time"] > self.ttl:
+            return None
+        return cache_item["device"]
+
+    def set(self, project_id, service, device_dict):
+        with self.lock:
+            self.cache_dict.setdefault(project_id, dict())[service] = {"update_time": time.time(),
+                                                                      "device": device_dict}
+
+
 # noinspection PyUnresolvedReferences,DuplicatedCode
 class BaseInstance(object):
     def __init__(self, base_client, config, credentials, endpoint):
@@ -125,9 +255,12 @@ class BaseInstance(object):
     def set_req_method(self):
         pass
 
+    def get_items(self, response_dict):
+        return response_dict[self.ret_filed]
+
     def parse_response_data(self, response_dict):
         dict_data = dict()
-        for item in response_dict[self.ret_filed]:
+        for item in self.get_items(response_dict):
             dict_data[item["id"]] = {
                 "name": item["name"],
                 "instance_type": self.instance_name
@@ -141,6 +274,47 @@ class BaseInstance(object):
         ret = show_infos_method(show_infos_req)
         return ret.to_dict()
 
+    def next_page(self, response_dict, item_list, limit, page_kwargs):
+        """
+        The marker style, the marker of the next page is the id of the last item
+        :return: dict, the kwargs of the next page besides the limit, None if it is the last page
+        """
+        if len(item_list) < limit:
+            return None
+        return {"marker": item_list[-1]["id"]}
+
+    def iter_pages(self, limit):
+        """
+        Follow the next page one by one and yield the response as soon as it arrives,
+        the count of page and the cost are recorded and printed at the end
+        :param limit: int, the size of one page, not more than the max limit of the service
+        :return: generator, the response dict of every page
+        """
+        limit = min(limit, getattr(self, "max_limit", limit))
+        page_kwargs = dict()
+        self.page_count, self.item_count, self.page_cost = 0, 0, list()
+        while page_kwargs is not None:
+            start_time = time.time()
+            response_dict = self.show_infos(limit=limit, **page_kwargs)
+            self.page_cost.append(time.time() - start_time)
+            item_list = self.get_items(response_dict) or list()
+            self.page_count += 1
+            self.item_count += len(item_list)
+            yield response_dict
+            page_kwargs = self.next_page(response_dict, item_list, limit, page_kwargs) if item_list else None
+        print("query {}: the count of page:{}, the count of item:{}, cost:{:.2f}s, the max cost of page:{:.2f}s".format(
+            getattr(self, "instance_name", self.__class__.__name__), self.page_count, self.item_count,
+            sum(self.page_cost), max(self.page_cost)))
+
+    def iter_infos(self, limit):
+        """
+        :param limit: int, the size of one page
+        :return: generator, the item of every page
+        """
+        for response_dict in self.iter_pages(limit):
+            for item in self.get_items(response_dict) or list():
+                yield item
+
 
 class EipInstanceV2(BaseInstance):
     def __init__(self, *args, **kwargs):
@@ -149,7 +323,7 @@ class EipInstanceV2(BaseInstance):
     def set_req_method(self):
         return ListPublicipsRequestV2, "list_publicips"
 
-    def parse_response_data(self, response_dict):
+    def get_items(self, response_dict):
         return response_dict['publicips']
 
 
@@ -160,9 +334,15 @@ class EipInstanceV3(BaseInstance):
     def set_req_method(self):
         return ListPublicipsRequestV3, "list_publicips"
 
-    def parse_response_data(self, response_dict):
+    def get_items(self, response_dict):
         return response_dict['publicips']
 
+    def next_page(self, response_dict, item_list, limit, page_kwargs):
+        page_info = response_dict.get("page_info") or dict()
+        if not page_info.get("next_marker"):
+            return None
+        return {"marker": page_info["next_marker"]}
+
 
 class NatInstance(BaseInstance):
     def __init__(self, *args, **kwargs):
@@ -190,6 +370,12 @@ class BMSInstance(BaseInstance):
         self.instance_name = "裸金属服务器"
         self.ret_filed = "servers"
 
+    def next_page(self, response_dict, item_list, limit, page_kwargs):
+        # the offset of bms is the page number, starting from 1
+        if len(item_list) < limit:
+            return None
+        return {"offset": page_kwargs.get("offset", 1) + 1}
+
     def set_req_method(self):
         return ListBareMetalServersRequest, "list_bare_metal_servers"
 
@@ -209,15 +395,24 @@ class RdsInstance(BaseInstance):
         super(RdsInstance, self).__init__(*args, **kwargs)
         self.instance_name = "云数据库 RDS"
         self.ret_filed = "instances"
+        self.max_limit = 100
 
     def set_req_method(self):
         return ListInstancesRequest, "list_instances"
 
+    def next_page(self, response_dict, item_list, limit, page_kwargs):
+        # the offset of rds is the index of the first item
+        offset = page_kwargs.get("offset", 0) + len(item_list)
+        if len(item_list) < limit or offset >= (response_dict.get("total_count") or 0):
+            return None
+        return {"offset": offset}
+
 
 # noinspection DuplicatedCode
 class EipTools(object):
     def __init__(self, *args, **kwargs):
         super(EipTools, self).__init__(*args, **kwargs)
+        self.device_cache = None
 
     @classmethod
     def get_eip_config(cls):
@@ -226,38 +421,89 @@ class EipTools(object):
         return config
 
     @classmethod
-    def output_excel(cls, eip_info_list, username):
-        if os.path.exists(GlobalConfig.excel_path):
-            work_book = openpyxl.load_workbook(GlobalConfig.excel_path)
-        else:
-            work_book = openpyxl.Workbook()
-        if username not in work_book.get_sheet_names():
-            work_book.create_sheet(username)
-        if GlobalConfig.need_delete_sheet_name in work_book.get_sheet_names():
-            need_remove_sheet = work_book.get_sheet_by_name(GlobalConfig.need_delete_sheet_name)
-            work_book.remove_sheet(need_remove_sheet)
-        table = work_book.get_sheet_by_name(username)
-        table.delete_rows(1, 65536)
-        table.append(GlobalConfig.excel_title)
-        for eip_info in eip_info_list:
-            table.append(eip_info)
-        work_book.save(GlobalConfig.excel_path)
+    def output_excel(cls, excel_writer, eip_info_list, username):
+        excel_writer.add_sheet(username, GlobalConfig.excel_title, eip_info_list)
+
+    @classmethod
+    def query_device_info(cls, instance_temp):
+        device_info = dict()
+        for instance_info in instance_temp.iter_pages(GlobalConfig.device_page_limit):
+            device_info.update(instance_temp.parse_response_data(instance_info))
+        return device_info
+
+    def get_service_device(self, project_id, instance_dict, executor, service_list=None):
+        """
+        Query the device list of the services concurrently, so one zone costs the slowest service, not the sum
+        :param service_list: list, only query these services regardless of the device cache,
+                             None means all services, and the service in the device cache not expired is not queried
+        :return: tuple, ({service: {device_id: device}}, the set of service queried)
+        """
+        service_device_dict, task_dict = dict(), dict()
+        for service, instance_temp in instance_dict.items():
+            if service_list is not None:
+                if service not in service_list:
+                    continue
+                device_dict = None
+            elif self.device_cache is not None:
+                device_dict = self.device_cache.get(project_id, service)
+            else:
+                device_dict = None
+            if device_dict is None:
+                task_dict[service] = executor.submit(self.query_device_info, instance_temp)
+            else:
+                service_device_dict[service] = device_dict
+        for service, task in task_dict.items():
+            service_device_dict[service] = task.result()
+            if self.device_cache is not None:
+                self.device_cache.set(project_id, service, service_device_dict[service])
+        return service_device_dict, set(task_dict.keys())
 
     @classmethod
-    def get_device_info(cls, instance_list):
+    def get_device_info(cls, service_device_dict):
+        """
+        Merge the devices in the order of device_service_list, the first one wins
+        :return: dict, {device_id: {"name": name, "instance_type": instance_type}}
+        """
         ret_dict = dict()
-        for instance_temp in instance_list:
-            instance_info = instance_temp.show_infos()
-            device_info = instance_temp.parse_response_data(instance_info)
-            for key, value in device_info.items():
+        for service in GlobalConfig.device_service_list:
+            for key, value in service_device_dict.get(service, dict()).items():
                 if key not in ret_dict.keys():
                     ret_dict[key] = value
         return ret_dict
 
+    @classmethod
+    def get_missing_service(cls, eip_list, device_info_dict):
+        """
+        Find the devices the eips point to but missing in the device index, in the same way as parse_ips_v3
+        :return: set, the services may own the missing devices
+        """
+        service_set = set()
+        for eip_info in eip_list:
+            vnic = eip_info.get("vnic")
+            if not isinstance(vnic, dict):
+                device_id = eip_info.get("associate_instance_id")
+                service_list = GlobalConfig.associate_service_dict.get(eip_info.get("associate_instance_type"),
+                                                                       GlobalConfig.device_service_list)
+            elif not vnic.get("device_id") and vnic.get("instance_type") == "RDS":
+                device_id, service_list = vnic.get("instance_id"), ["rds"]
+            else:
+                device_id, service_list = vnic.get("device_id"), ["ecs", "bms"]
+            if device_id and device_id not in device_info_dict:
+                service_set.update(service_list)
+        return service_set
+
     @classmethod
     def parse_input_args(cls):
         par = argparse.ArgumentParser()
         par.add_argument("-config_path", "--config_path", help="The config path of object", required=False)
+        par.add_argument("-zone_worker", "--zone_worker", help="The count of zones collected concurrently", type=int,
+                         default=GlobalConfig.zone_worker, required=False)
+        par.add_argument("-output_format", "--output_format", nargs="+", choices=GlobalConfig.output_format_list,
+                         default=GlobalConfig.output_format_list[:1], help="The formats of output", required=False)
+        par.add_argument("-device_cache_ttl", "--device_cache_ttl", type=int, default=GlobalConfig.device_cache_ttl,
+                         help="The seconds the device index is cached across runs, 0 means no cache", required=False)
+        par.add_argument("-refresh_device_cache", "--refresh_device_cache", action="store_true",
+                         help="Query all devices again and refresh the device cache", required=False)
         args = par.parse_args()
         return args
 
@@ -378,16 +624,54 @@ class EipTools(object):
         bms_instance = BMSInstance(BmsClient, config, credentials, EndPoint.bms_endpoint.format(zone))
         ecs_instance = EcsInstance(EcsClient, config, credentials, EndPoint.ecs_endpoint.format(zone))
         rds_instance = RdsInstance(RdsClient, config, credentials, EndPoint.rds_endpoint.format(zone))
-        query_device_lists = [nat_instance, elb_instance, bms_instance, ecs_instance, rds_instance]
-        device_info_dict = eip_tools.get_device_info(query_device_lists)
-        eip_dict = eip_instance.show_infos()
-        eip_list = eip_instance.parse_response_data(eip_dict)
+        instance_dict = dict(zip(GlobalConfig.device_service_list,
+                                 [nat_instance, elb_instance, bms_instance, ecs_instance, rds_instance]))
+        # the eip v2 zone does not map the eip to the device, only the eip list is needed
+        if zone in GlobalConfig.eip_v2_zone:
+            instance_dict = dict()
+        with ThreadPoolExecutor(max_workers=len(instance_dict) + 1) as executor:
+            eip_task = executor.submit(list, eip_instance.iter_infos(GlobalConfig.eip_page_limit))
+            service_device_dict, queried_set = self.get_service_device(project_id, instance_dict, executor)
+            eip_list = eip_task.result()
+            device_info_dict = eip_tools.get_device_info(service_device_dict)
+            # the cached index is stale if an eip points to an unknown device, only refetch the services may own it
+            refresh_list = [service for service in eip_tools.get_missing_service(eip_list, device_info_dict)
+                            if service in instance_dict and service not in queried_set]
+            if refresh_list:
+                print("The zone of info:{} refresh the device of:{}".format(zone, ",".join(refresh_list)))
+                refresh_device_dict, _ = self.get_service_device(project_id, instance_dict, executor, refresh_list)
+                service_device_dict.update(refresh_device_dict)
+                device_info_dict = eip_tools.get_device_info(service_device_dict)
         if zone in GlobalConfig.eip_v2_zone:
             result_list = eip_tools.parse_ips_v2(eip_list, zone)
         else:
             result_list = eip_tools.parse_ips_v3(eip_list, device_info_dict, zone)
         return result_list
 
+    def get_zone_data(self, eip_tools, project_temp, ak, sk):
+        start_time = time.time()
+        try:
+            ret_temp = self.get_data_list(eip_tools, project_temp, ak, sk)
+        except Exception as e:
+            print("Collect the zone of info:{} failed, err:{}".format(project_temp["zone"], e))
+            ret_temp = None
+        print("Collect the zone of info:{}, the count of ip:{}, cost:{:.2f}s".format(
+            project_temp["zone"], len(ret_temp or []), time.time() - start_time))
+        return ret_temp or []
+
+    def collect_zone_data(self, eip_tools, project_info, ak, sk, zone_worker):
+        """
+        Query all projects of one account concurrently, a failed zone only loses its own result
+        :return: list, the merged result of every zone in the order of project_info
+        """
+        result_list = list()
+        with ThreadPoolExecutor(max_workers=zone_worker) as executor:
+            all_task = [executor.submit(self.get_zone_data, eip_tools, project_temp, ak, sk)
+                        for project_temp in project_info]
+            for task in all_task:
+                result_list.extend(task.result())
+        return result_list
+
 
 # noinspection DuplicatedCode
 def main():
@@ -400,23 +684,42 @@ def main():
         config_path = input_args.config_path
     config_list = eip_tools.load_yaml(config_path)
     eip_tools.check_config_data(config_list)
-    print("############2.start to collect and output to excel######")
+    if input_args.device_cache_ttl:
+        # the refreshed cache expires at once, every service is queried and saved again
+        eip_tools.device_cache = DeviceCache(GlobalConfig.device_cache_path,
+                                             0 if input_args.refresh_device_cache else input_args.device_cache_ttl)
+    excel_writer = None
+    if "excel" in input_args.output_format:
+        excel_writer = ExcelWriter(GlobalConfig.excel_path)
+    column_writer_dict = dict()
+    if "parquet" in input_args.output_format:
+        column_writer_dict[GlobalConfig.parquet_path] = ParquetWriter(GlobalConfig.parquet_path)
+    if "csv" in input_args.output_format:
+        column_writer_dict[GlobalConfig.csv_path] = CsvWriter(GlobalConfig.csv_path)
+    print("############2.start to collect and output to {}######".format(",".join(input_args.output_format)))
     for config_item in config_list:
-        result_list = list()
         username = config_item['account']
         ak = config_item["ak"]
         sk = config_item["sk"]
         project_info = config_item["project_info"]
         print("Collect the username of info:{}".format(username))
-        for project_temp in project_info:
-            print("Collect the zone of info:{}".format(project_temp["zone"]))
-            ret_temp = eip_tools.get_data_list(eip_tools, project_temp, ak, sk)
-            result_list.extend(ret_temp or [])
-        print("Write the data to excel...")
-        if result_list:
-            eip_tools.output_excel(result_list, username)
-        else:
-            print("There is no data to write to excel.")
+        result_list = eip_tools.collect_zone_data(eip_tools, project_info, ak, sk, input_args.zone_worker)
+        print("Write the data to {}...".format(",".join(input_args.output_format)))
+        if not result_list:
+            print("There is no data to write.")
+            continue
+        if excel_writer is not None:
+            eip_tools.output_excel(excel_writer, result_list, username)
+        for column_writer in column_writer_dict.values():
+            column_writer.add_rows(username, result_list)
+    if eip_tools.device_cache is not None:
+        eip_tools.device_cache.save()
+    for path, column_writer in column_writer_dict.items():
+        print("Write the {}...".format(path))
+        column_writer.save()
+    if excel_writer is not None:
+        print("Write the excel:{}...".format(GlobalConfig.excel_path))
+        excel_writer.save()
     print("##################3.finish################")
 
 
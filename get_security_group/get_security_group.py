@@ -1,4 +1,8 @@
 # -*- coding: utf-8 -*-
+import os
+import json
+import time
+import hashlib
 import logging
 
 import huaweicloudsdkcore
@@ -24,6 +28,8 @@ class Config(object):
     obs_bucket_name = "obs-for-openeuler-developer"
     obs_bucket_key = "secret-files/collect_elastic_public_ip.yaml"
     ecs_endpoint = "https://vpc.{}.myhuaweicloud.com"
+    project_cache_path = os.path.join(os.path.dirname(__file__), "project_zone_cache.json")
+    project_cache_ttl = 7 * 24 * 3600
     zone_alias_dict = {
         "cn-north-1": "华北-北京一",
         "cn-north-4": "华北-北京四",
@@ -100,6 +106,42 @@ class ObsImp(object):
         return now_account_info_list
 
 
+class ProjectCache(object):
+    """The project list of every ak persisted on disk, keyed by the hash of ak and expired after ttl seconds"""
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+
+    @staticmethod
+    def get_key(ak):
+        return hashlib.sha256(ak.encode("utf-8")).hexdigest()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return dict()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error("load project cache:{} failed, err:{}".format(self.path, e))
+            return dict()
+
+    def get(self, ak):
+        cache_item = self.load().get(self.get_key(ak))
+        if not cache_item or time.time() - cache_item["update_time"] >= self.ttl:
+            return None
+        return cache_item["project_info"]
+
+    def set(self, ak, project_info):
+        cache_dict = self.load()
+        cache_dict[self.get_key(ak)] = {"update_time": time.time(), "project_info": project_info}
+        temp_path = "{}.tmp".format(self.path)
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(cache_dict, f)
+        os.replace(temp_path, self.path)
+
+
 class BaseImp(object):
     def __init__(self):
         self.config = HttpConfig.get_default_config()
@@ -111,23 +153,37 @@ class BaseImp(object):
 class IamImp(BaseImp):
     def __init__(self, ak, sk, zone="ap-southeast-1"):
         super(IamImp, self).__init__()
-        credentials = GlobalCredentials(ak, sk)
-        self.client = IamClient.new_builder().with_http_config(self.config) \
+        self.ak = ak
+        self.sk = sk
+        self.zone = zone
+
+    def get_client(self):
+        # with_region fetches the domain id from iam, so the client is only built on a cache miss
+        credentials = GlobalCredentials(self.ak, self.sk)
+        return IamClient.new_builder().with_http_config(self.config) \
             .with_credentials(credentials) \
-            .with_region(IamRegion.value_of(zone)) \
+            .with_region(IamRegion.value_of(self.zone)) \
             .build()
 
-    def get_project_zone(self):
-        """get the zone and project from iam"""
+    def get_project_zone(self, project_cache=None, refresh=False):
+        """get the zone and project from iam, or from the project cache if it is not expired"""
+        if project_cache is not None and not refresh:
+            list_data = project_cache.get(self.ak)
+            if list_data is not None:
+                logger.info("[get_project_zone] hit project cache total:{}".format(len(list_data)))
+                return list_data
         list_data = list()
+        client = self.get_client()
         try:
             request = KeystoneListProjectsRequest()
-            response = self.client.keystone_list_projects(request)
+            response = client.keystone_list_projects(request)
             for info in response.projects:
                 if info.name in ["cn-northeast-1", "MOS", "ap-southeast-1_tryme", "cn-north-1_1"]:
                     continue
                 list_data.append({"zone": info.name, "project_id": info.id})
             logger.info("[get_project_zone] collect project total:{}".format(len(list_data)))
+            if project_cache is not None and list_data:
+                project_cache.set(self.ak, list_data)
             return list_data
         except exceptions.ClientRequestException as e:
             msg = "[HWCloudIAM] ak:{}, sk:{} get project zone failed:{},{}".format(e.status_code, e.request_id,
@@ -191,13 +247,18 @@ class SecurityRuleImp(BaseImp):
 @click.option("--sk", help="the obs sk")
 @click.option("--url", help="the obs url")
 @click.option("--ip", help="the ip")
-def main(ak, sk, url, ip):
+@click.option("--cache_ttl", default=Config.project_cache_ttl, type=int,
+              help="the seconds to cache the project list, 0 means no cache")
+@click.option("--refresh", is_flag=True, default=False, help="ignore the cached project list")
+def main(ak, sk, url, ip, cache_ttl, refresh):
     ip_dict = defaultdict(list)
+    project_cache = ProjectCache(Config.project_cache_path, cache_ttl) if cache_ttl else None
     logger.info("-" * 25 + "start to get config from obs" + "-" * 25)
     obs_imp = ObsImp(ak, sk, url)
     account_info_list = obs_imp.get_obs_data(Config.obs_bucket_name, Config.obs_bucket_key)
     for account_info in account_info_list:
-        account_info["project_info"] = IamImp(account_info["ak"], account_info["sk"]).get_project_zone()
+        iam_imp = IamImp(account_info["ak"], account_info["sk"])
+        account_info["project_info"] = iam_imp.get_project_zone(project_cache, refresh)
     logger.info("-" * 25 + "start to get ip info from security_group" + "-" * 25)
     for account_info in account_info_list:
         account = account_info["account"]
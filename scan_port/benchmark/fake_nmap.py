@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/20 10:30
+# @Author  : Tom_zc
+# @FileName: fake_nmap.py
+# @Software: PyCharm
+"""
+Stand in for the nmap binary in the benchmark, only the options used by scan_port are supported:
+-sS/-sU, -p, -iL, -oG/-oX, the others are ignored.
+The latency and the result are controlled by the environment variables:
+FAKE_NMAP_LATENCY: the seconds of every invocation, default 0.5
+FAKE_NMAP_HOST_LATENCY: the seconds of every target host, default 0.001
+FAKE_NMAP_OPEN_PORT: the open ports of every up host, default 22,80
+FAKE_NMAP_UP_RATIO: the ratio of the up host, default 1.0
+"""
+import os
+import sys
+import time
+import socket
+import zlib
+
+
+def get_service(port, proto):
+    try:
+        return socket.getservbyport(port, proto)
+    except OSError:
+        return ""
+
+
+def is_up(ip, up_ratio):
+    # stable for the same ip, so the tcp and udp scan agree with each other
+    return zlib.crc32(ip.encode("utf-8")) % 10000 < up_ratio * 10000
+
+
+def output_grepable(path, cmd, ip_list, up_list, port_list, proto, cost):
+    with open(path, "w") as f:
+        f.write("# Nmap 7.92 scan initiated {} as: {}\n".format(time.strftime("%a %b %d %H:%M:%S %Y"), cmd))
+        for ip in up_list:
+            f.write("Host: {} ()\tStatus: Up\n".format(ip))
+            port_info = ", ".join("{}/open/{}//{}///".format(port, proto, get_service(port, proto))
+                                  for port in port_list)
+            f.write("Host: {} ()\tPorts: {}\tIgnored State: filtered (998)\n".format(ip, port_info))
+        f.write("# Nmap done at {} -- {} IP addresses ({} hosts up) scanned in {:.2f} seconds\n".format(
+            time.strftime("%a %b %d %H:%M:%S %Y"), len(ip_list), len(up_list), cost))
+
+
+def output_xml(path, cmd, ip_list, up_list, port_list, proto, cost):
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write('<nmaprun scanner="nmap" args="{}" start="{}" version="7.92" xmloutputversion="1.05">\n'.format(
+            cmd, int(time.time())))
+        for index, ip in enumerate(up_list):
+            f.write('<host><status state="up" reason="user-set" reason_ttl="0"/>\n')
+            f.write('<address addr="{}" addrtype="ipv4"/>\n<ports>'.format(ip))
+            f.write('<extraports state="filtered" count="998"/>\n')
+            for port in port_list:
+                f.write('<port protocol="{}" portid="{}"><state state="open" reason="syn-ack" reason_ttl="50"/>'
+                        '<service name="{}" method="table" conf="3"/></port>\n'.format(proto, port,
+                                                                                      get_service(port, proto)))
+            srtt = 2000 + index % 50 * 1000
+            f.write('</ports>\n<times srtt="{}" rttvar="{}" to="100000"/>\n</host>\n'.format(srtt, srtt // 4))
+        f.write('<runstats><finished time="{}" elapsed="{:.2f}" exit="success"/>'
+                '<hosts up="{}" down="{}" total="{}"/></runstats>\n</nmaprun>\n'.format(
+                    int(time.time()), cost, len(up_list), len(ip_list) - len(up_list), len(ip_list)))
+
+
+def main():
+    argv = sys.argv[1:]
+    start_time = time.time()
+    proto = "udp" if "-sU" in argv else "tcp"
+    with open(argv[argv.index("-iL") + 1], "r") as f:
+        ip_list = f.read().split()
+    if "-p" in argv:
+        port_list = [int(port) for port in argv[argv.index("-p") + 1].split(",")]
+    else:
+        port_list = [int(port) for port in os.environ.get("FAKE_NMAP_OPEN_PORT", "22,80").split(",")]
+    up_ratio = float(os.environ.get("FAKE_NMAP_UP_RATIO", "1.0"))
+    up_list = [ip for ip in ip_list if is_up(ip, up_ratio)]
+    time.sleep(float(os.environ.get("FAKE_NMAP_LATENCY", "0.5")) +
+               float(os.environ.get("FAKE_NMAP_HOST_LATENCY", "0.001")) * len(ip_list))
+    cmd = " ".join(["nmap"] + argv)
+    print("Starting Nmap 7.92 ( https://nmap.org ) at {}".format(time.strftime("%Y-%m-%d %H:%M %Z")))
+    cost = time.time() - start_time
+    if "-oX" in argv:
+        output_xml(argv[argv.index("-oX") + 1], cmd, ip_list, up_list, port_list, proto, cost)
+    if "-oG" in argv:
+        output_grepable(argv[argv.index("-oG") + 1], cmd, ip_list, up_list, port_list, proto, cost)
+    print("Nmap done: {} IP addresses ({} hosts up) scanned in {:.2f} seconds".format(len(ip_list), len(up_list),
+                                                                                    cost))
+
+
+if __name__ == "__main__":
+    main()
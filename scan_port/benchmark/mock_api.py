@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/20 10:30
+# @Author  : Tom_zc
+# @FileName: mock_api.py
+# @Software: PyCharm
+"""
+Local http server standing in for the iam and eip api in the benchmark,
+the other requests are answered with a Server header, so it is the target of the banner stage too
+"""
+import re
+import json
+import argparse
+import threading
+import ipaddress
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class MockApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_header = "nginx/1.20.1"
+    eip_v3_pattern = re.compile(r"^/v3/([^/]+)/eip/publicips$")
+    eip_v2_pattern = re.compile(r"^/v1/([^/]+)/publicips$")
+
+    def log_message(self, format, *args):
+        pass
+
+    def version_string(self):
+        return self.server_header
+
+    def send_json(self, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Request-Id", "mock")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_page(self, project_id, query_dict):
+        eip_list = self.server.eip_dict.get(project_id, list())
+        limit = int(query_dict.get("limit", ["1000"])[0])
+        marker = query_dict.get("marker", [None])[0]
+        start = 0
+        if marker:
+            start = next((index + 1 for index, eip in enumerate(eip_list) if eip["id"] == marker), len(eip_list))
+        return eip_list[start:start + limit], start + limit < len(eip_list)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query_dict = parse_qs(url.query)
+        if url.path == "/v3/auth/domains":
+            return self.send_json({"domains": [{"id": "mock_domain", "name": "mock", "enabled": True}]})
+        if url.path == "/v3/projects":
+            return self.send_json({"projects": [{"id": project_id, "name": zone, "enabled": True}
+                                                for zone, project_id in self.server.project_list]})
+        match = self.eip_v3_pattern.match(url.path)
+        if match:
+            page_list, has_next = self.get_page(match.group(1), query_dict)
+            page_info = {"current_count": len(page_list), "previous_marker": ""}
+            if has_next:
+                page_info["next_marker"] = page_list[-1]["id"]
+            return self.send_json({"publicips": page_list, "page_info": page_info, "request_id": "mock"})
+        match = self.eip_v2_pattern.match(url.path)
+        if match:
+            page_list, _ = self.get_page(match.group(1), query_dict)
+            return self.send_json({"publicips": page_list})
+        self.send_banner()
+
+    def do_HEAD(self):
+        self.send_banner(has_body=False)
+
+    def send_banner(self, has_body=True):
+        body = b"<html><body>mock</body></html>"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if has_body:
+            self.wfile.write(body)
+
+
+class MockApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, ip_count, zone_count, start_ip):
+        super(MockApiServer, self).__init__(address, MockApiHandler)
+        self.project_list = [("mock-zone-{}".format(index), "project{}".format(index)) for index in range(zone_count)]
+        self.eip_dict = {project_id: list() for _, project_id in self.project_list}
+        start_ip = int(ipaddress.IPv4Address(start_ip))
+        for index in range(ip_count):
+            _, project_id = self.project_list[index % zone_count]
+            self.eip_dict[project_id].append({
+                "id": "eip-{:08d}".format(index),
+                "public_ip_address": str(ipaddress.IPv4Address(start_ip + index)),
+                "status": "ACTIVE",
+                "type": "EIP",
+            })
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def main():
+    par = argparse.ArgumentParser()
+    par.add_argument("-port", "--port", type=int, default=18443, help="The port to listen")
+    par.add_argument("-ip_count", "--ip_count", type=int, default=1000, help="The count of eip")
+    par.add_argument("-zone_count", "--zone_count", type=int, default=4, help="The count of zone")
+    par.add_argument("-start_ip", "--start_ip", default="127.1.0.0", help="The first eip")
+    args = par.parse_args()
+    server = MockApiServer(("", args.port), args.ip_count, args.zone_count, args.start_ip)
+    print("mock api listen on:{}, the count of eip:{}".format(args.port, args.ip_count))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/20 10:30
+# @Author  : Tom_zc
+# @FileName: run_benchmark.py
+# @Software: PyCharm
+"""
+Run scan_port end to end without network: nmap is replaced by fake_nmap.py and the iam/eip api by mock_api.py,
+every run works in its own temp dir, and the cost of every stage and the peak rss are reported
+"""
+import os
+import sys
+import json
+import time
+import yaml
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from mock_api import MockApiServer
+
+base_path = os.path.dirname(os.path.abspath(__file__))
+scan_port_path = os.path.join(os.path.dirname(base_path), "scan_port.py")
+fake_nmap_path = os.path.join(base_path, "fake_nmap.py")
+stage_list = ["discovery", "tcp", "udp", "banner", "excel"]
+
+
+def parse_input_args():
+    par = argparse.ArgumentParser()
+    par.add_argument("-size_list", "--size_list", default="100,1000,10000", help="The count of ip of every run")
+    par.add_argument("-zone_count", "--zone_count", type=int, default=4, help="The count of zone of the mock api")
+    par.add_argument("-latency", "--latency", default="0.5", help="The seconds of every fake nmap invocation")
+    par.add_argument("-host_latency", "--host_latency", default="0.001", help="The seconds of every target host")
+    par.add_argument("-up_ratio", "--up_ratio", default="0.3", help="The ratio of the up host")
+    par.add_argument("-scan_output", "--scan_output", default="grepable", choices=["grepable", "xml"],
+                     help="The output format of nmap")
+    par.add_argument("-report_path", "--report_path", required=False, help="The json path of the summary")
+    par.add_argument("-keep_work_dir", "--keep_work_dir", action="store_true", help="Keep the work dir of every run")
+    return par.parse_args()
+
+
+def prepare_work_dir(work_dir, mock_port, scan_output):
+    shutil.copy(scan_port_path, work_dir)
+    bin_dir = os.path.join(work_dir, "bin")
+    os.makedirs(bin_dir)
+    nmap_path = os.path.join(bin_dir, "nmap")
+    with open(nmap_path, "w") as f:
+        f.write('#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, fake_nmap_path))
+    os.chmod(nmap_path, 0o755)
+    config_dict = {
+        "high_risk_port": [22, mock_port],
+        "scan_output": scan_output,
+        "project_cache_ttl": 0,
+        "account_info": [{"ak": "mock_ak", "sk": "mock_sk", "account": "benchmark"}],
+    }
+    config_path = os.path.join(work_dir, "scan_port.yaml")
+    with open(config_path, "w") as f:
+        yaml.safe_dump(config_dict, f)
+    return bin_dir, config_path
+
+
+def run_once(ip_count, args):
+    server = MockApiServer(("", 0), ip_count, args.zone_count, "127.1.0.0")
+    server.start()
+    mock_port = server.server_address[1]
+    mock_endpoint = "http://127.0.0.1:{}".format(mock_port)
+    work_dir = tempfile.mkdtemp(prefix="scan_port_benchmark_")
+    try:
+        bin_dir, config_path = prepare_work_dir(work_dir, mock_port, args.scan_output)
+        env = dict(os.environ)
+        env.update({
+            "PATH": bin_dir + os.pathsep + env.get("PATH", ""),
+            "SCAN_PORT_ENDPOINT": mock_endpoint,
+            "HUAWEICLOUD_SDK_IAM_ENDPOINT": mock_endpoint,
+            "FAKE_NMAP_LATENCY": args.latency,
+            "FAKE_NMAP_HOST_LATENCY": args.host_latency,
+            "FAKE_NMAP_OPEN_PORT": "22,{}".format(mock_port),
+            "FAKE_NMAP_UP_RATIO": args.up_ratio,
+        })
+        report_path = os.path.join(work_dir, "stage_report.json")
+        log_path = os.path.join(work_dir, "scan_port.log")
+        start_time = time.time()
+        with open(log_path, "w") as log:
+            ret = subprocess.call([sys.executable, os.path.join(work_dir, "scan_port.py"), "--config_path",
+                                   config_path, "--stage_report", report_path],
+                                  cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        cost = time.time() - start_time
+        if ret != 0 or not os.path.exists(report_path):
+            raise Exception("scan_port exit with:{}, see the log:{}".format(ret, log_path))
+        with open(report_path, "r") as f:
+            report = json.load(f)
+        report.update({"ip_count": ip_count, "wall": round(cost, 3)})
+        return report
+    finally:
+        server.shutdown()
+        server.server_close()
+        if args.keep_work_dir:
+            print("keep the work dir:{}".format(work_dir))
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def output_table(report_list):
+    title_list = ["ip", "wall(s)"] + ["{}(s)".format(stage) for stage in stage_list] + ["rss(MB)", "nmap rss(MB)"]
+    print("\t".join(title_list))
+    for report in report_list:
+        row = [report["ip_count"], report["wall"]] + [report["stage"].get(stage, "-") for stage in stage_list]
+        row += [round(report["peak_rss_kb"] / 1024.0, 1), round(report["children_peak_rss_kb"] / 1024.0, 1)]
+        print("\t".join(str(item) for item in row))
+
+
+def main():
+    args = parse_input_args()
+    report_list = list()
+    for ip_count in [int(size) for size in args.size_list.split(",")]:
+        print("run the benchmark, the count of ip:{}...".format(ip_count))
+        report_list.append(run_once(ip_count, args))
+    output_table(report_list)
+    if args.report_path:
+        with open(args.report_path, "w") as f:
+            json.dump(report_list, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2022/9/26 10:30
+# @Author  : Tom_zc
+# @FileName: query_history.py
+# @Software: PyCharm
+import time
+import argparse
+
+from scan_port import GlobalConfig, ScanHistory
+
+
+def format_time(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+
+def parse_input_args():
+    par = argparse.ArgumentParser()
+    par.add_argument("-history_path", "--history_path", help="The path of the scan history",
+                     default=GlobalConfig.scan_history_path, required=False)
+    sub_par = par.add_subparsers(dest="command")
+    first_open_par = sub_par.add_parser("first_open", help="When did the port first open on the ip")
+    first_open_par.add_argument("--ip", required=True)
+    first_open_par.add_argument("--port", type=int, required=True)
+    first_open_par.add_argument("--proto", default="tcp", choices=["tcp", "udp"])
+    exposed_par = sub_par.add_parser("exposed", help="All ips exposing the port in the last days")
+    exposed_par.add_argument("--port", type=int, required=True)
+    exposed_par.add_argument("--days", type=float, default=7)
+    exposed_par.add_argument("--proto", default="tcp", choices=["tcp", "udp"])
+    ip_par = sub_par.add_parser("ip", help="The port history of the ip")
+    ip_par.add_argument("--ip", required=True)
+    args = par.parse_args()
+    if args.command is None:
+        par.error("the command is required")
+    return args
+
+
+def main():
+    args = parse_input_args()
+    scan_history = ScanHistory(args.history_path)
+    start_time = time.time()
+    if args.command == "first_open":
+        first_time = scan_history.get_first_open(args.ip, args.port, args.proto)
+        if first_time is None:
+            print("{}/{} is never seen open on:{}".format(args.port, args.proto, args.ip))
+        else:
+            print("{}/{} is first seen open on:{} at {}".format(args.port, args.proto, args.ip, format_time(first_time)))
+    elif args.command == "exposed":
+        row_list = scan_history.list_exposed_ip(args.port, time.time() - args.days * 86400, args.proto)
+        for ip, account, scan_time in row_list:
+            print("{}\t{}\t{}".format(ip, account, format_time(scan_time)))
+        print("the count of ip exposing {}/{} in the last {} days:{}".format(args.port, args.proto, args.days,
+                                                                            len(row_list)))
+    else:
+        for scan_time, port, proto, state, banner, account in scan_history.list_ip_history(args.ip):
+            print("{}\t{}/{}\t{}\t{}\t{}".format(format_time(scan_time), port, proto, state, banner or "", account))
+    print("query cost:{:.3f}ms".format((time.time() - start_time) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,18 +5,31 @@
 # @Software: PyCharm
 import os
 import re
+import json
+import hashlib
+import resource
+import sqlite3
+import threading
+import socket
+import asyncio
+import ipaddress
 
 import requests
 import argparse
 import time
 import yaml
 import subprocess
+import tempfile
+import shutil
 import openpyxl
+from xml.etree import ElementTree
 from abc import abstractmethod
 from functools import wraps
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from contextlib import closing, contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
+from requests.packages.urllib3.exceptions import InsecureRequestWarning, NewConnectionError
 from huaweicloudsdkcore.auth.credentials import BasicCredentials
 from huaweicloudsdkcore.client import Client
 from huaweicloudsdkeip.v2 import EipClient as EipClientV2
@@ -37,8 +50,17 @@ class GlobalConfig(object):
     base_path = os.path.dirname(__file__)
     txt_path = os.path.join(base_path, "ip.txt")
     IGNORE_ZONE = ["cn-northeast-1", "MOS", "cn-north-1_1"]
+    project_cache_path = os.path.join(base_path, "project_zone_cache.json")
+    project_cache_ttl = 7 * 24 * 3600
+    scan_state_path = os.path.join(base_path, "scan_state.json")
+    scan_journal_path = os.path.join(base_path, "scan_port.journal")
+    port_delta = True
+    port_snapshot_path = os.path.join(base_path, "port_snapshot.json")
+    port_delta_path = os.path.join(base_path, "port_delta.json")
+    scan_history = True
+    scan_history_path = os.path.join(base_path, "scan_history.db")
+    rescan_window_days = 7
 
-    ip_result_path = os.path.join(base_path, "ip_result.txt")
     config_path = os.path.join(base_path, "scan_port.yaml")
     zone_alias_dict = {
         "cn-north-1": "华北-北京一",
@@ -62,14 +84,69 @@ class GlobalConfig(object):
         "ru-northwest-2": "俄罗斯-莫斯科二",
     }
     eip_v2_zone = ["cn-south-4", ]
+    ip_file_owner = "total_port"
+    target_batch_size = 4096
+    role_list = ["standalone", "coordinator", "worker"]
+    queue_path = os.path.join(base_path, "scan_queue.db")
+    queue_lease = 3600
+    queue_poll_interval = 5
+    queue_idle_timeout = 600
+    queue_stall_timeout = 300
+    eip_page_limit = 500
+    zone_worker = 8
 
     excel_path = os.path.join(base_path, "公网IP端口扫描统计表.xlsx")
-    excel_title = ["弹性公网IP", "端口", "状态", "链接协议", "传输协议"]
+    # the excel is written once from scratch, so scan_port_from_text.py writes its own file to keep both results
+    text_excel_path = os.path.join(base_path, "文本IP端口扫描统计表.xlsx")
+    excel_title = ["弹性公网IP", "端口", "状态", "链接协议", "传输协议", "版本", "原因", "TTL"]
     excel_server_info_title = ["弹性公网IP", "端口", "服务器版本信息"]
-    need_delete_sheet_name = "Sheet"
+    excel_delta_title = ["弹性公网IP", "端口", "传输协议", "open状态变化", "高危端口"]
 
-    tcp_search_cmd = "nmap -sS -Pn -n --open --min-hostgroup 4 --min-parallelism 1024 --host-timeout 180 -T4 -v -oG ip_result.txt {}"
-    udp_search_cmd = "nmap -sU --min-hostgroup 4 --min-parallelism 1024 --host-timeout 180 -v -oG ip_result.txt {}"
+    scan_engine = "nmap"
+    scan_engine_list = ["nmap", "connect"]
+    scan_batch_size = 256
+    scan_worker = 4
+    connect_concurrency = 1000
+    connect_timeout = 3
+    udp_engine = "nmap"
+    udp_engine_list = ["nmap", "probe"]
+    udp_probe_timeout = 2
+    udp_probe_retries = 2
+    scan_output = "grepable"
+    banner_worker = 32
+    banner_connect_timeout = 5
+    banner_read_timeout = 10
+    banner_head_first = True
+    banner_https_fallback = True
+    ip_target_name = "ip_target.txt"
+    ip_result_name_dict = {
+        "grepable": "ip_result.txt",
+        "xml": "ip_result.xml",
+    }
+    output_option_dict = {
+        "grepable": "-oG",
+        "xml": "-oX",
+    }
+    tcp_search_cmd = "nmap -sS -Pn -n --open --min-hostgroup {hostgroup} --min-parallelism {parallelism} --host-timeout {host_timeout} -T4 {rtt_option} -v {output_option} {output} -iL {target}"
+    udp_search_cmd = "nmap -sU {port_option} --min-hostgroup {hostgroup} --min-parallelism {parallelism} --host-timeout {host_timeout} {rtt_option} -v {output_option} {output} -iL {target}"
+    adaptive_rate = False
+    adaptive_loss_high = 0.05
+    adaptive_loss_low = 0.01
+    rate_option_dict = {
+        "parallelism": 1024,
+        "hostgroup": 4,
+        "host_timeout": 180,
+    }
+    rate_bound_dict = {
+        "parallelism": (16, 4096),
+        "hostgroup": (1, 256),
+        "host_timeout": (60, 900),
+        "max_rtt_timeout": (100, 3000),
+    }
+    search_cmd_dict = {
+        "tcp": tcp_search_cmd,
+        "udp": udp_search_cmd,
+    }
 
 
 # noinspection DuplicatedCode
@@ -80,6 +157,12 @@ class EndPoint(object):
     bms_endpoint = "https://bms.{}.myhuaweicloud.com"
     ecs_endpoint = "https://ecs.{}.myhuaweicloud.com"
     rds_endpoint = "https://rds.{}.myhuaweicloud.com"
+    override_env = "SCAN_PORT_ENDPOINT"
+
+    @classmethod
+    def get_endpoint(cls, endpoint, zone):
+        """The endpoint set in the environment variable replaces every service endpoint, e.g. a local mock server"""
+        return os.environ.get(cls.override_env) or endpoint.format(zone)
 
 
 def func_retry(tries=3, delay=1):
@@ -100,6 +183,336 @@ def func_retry(tries=3, delay=1):
     return deco_retry
 
 
+class PortRecord(namedtuple("PortRecord", ["ip", "port", "state", "proto", "owner", "service", "rpc_info",
+                                            "version", "reason", "ttl"], defaults=["", ""])):
+    __slots__ = ()
+
+    def to_row(self):
+        """[port, state, proto, service, version, reason, ttl], the row written to excel, "" for the missing field"""
+        return [str(self.port), self.state, self.proto, self.service, self.version, self.reason, str(self.ttl)]
+
+
+class GrepableParser(object):
+    """Single pass parser of the nmap grepable output(-oG), read line by line from a file or a pipe"""
+    host_pattern = re.compile(r"^Host: (\S+)")
+    port_pattern = re.compile(r"(\d+)/([^/]*)/([^/]*)/([^/]*)/([^/]*)/([^/]*)/([^/]*)/")
+
+    @classmethod
+    def iter_records(cls, line_iter):
+        """
+        :param line_iter: iterable, the lines of -oG output
+        :return: generator, PortRecord of every port in the Ports field
+        """
+        for line in line_iter:
+            host = cls.host_pattern.match(line)
+            if not host:
+                continue
+            for field in line.split("\t"):
+                if not field.startswith("Ports: "):
+                    continue
+                for port in cls.port_pattern.finditer(field, len("Ports: ")):
+                    port_num, state, proto, owner, service, rpc_info, version = port.groups()
+                    yield PortRecord(host.group(1), int(port_num), state, proto, owner, service, rpc_info, version)
+
+
+class XmlParser(object):
+    """Incremental parser of the nmap xml output(-oX), every host element is cleared as soon as it is parsed"""
+
+    @classmethod
+    def parse_host(cls, host_elem):
+        address = host_elem.find("address")
+        ports_elem = host_elem.find("ports")
+        if address is None or ports_elem is None:
+            return
+        ip = address.get("addr")
+        for port_elem in ports_elem.iter("port"):
+            state_elem = port_elem.find("state")
+            service_elem = port_elem.find("service")
+            owner_elem = port_elem.find("owner")
+            state, reason, ttl = "", "", ""
+            if state_elem is not None:
+                state, reason, ttl = state_elem.get("state", ""), state_elem.get("reason", ""), \
+                                     state_elem.get("reason_ttl", "")
+            service, version = "", ""
+            if service_elem is not None:
+                service = service_elem.get("name", "")
+                version = " ".join(service_elem.get(key) for key in ("product", "version", "extrainfo")
+                                   if service_elem.get(key))
+            owner = owner_elem.get("name", "") if owner_elem is not None else ""
+            yield PortRecord(ip, int(port_elem.get("portid")), state, port_elem.get("protocol", ""), owner, service,
+                             "", version, reason, ttl)
+
+    @classmethod
+    def iter_records(cls, source, rtt_list=None):
+        """
+        :param source: string or file object, the -oX output
+        :param rtt_list: list, if given, the smoothed rtt in microseconds of every host answered is appended to it
+        :return: generator, PortRecord of every port of every host
+        """
+        root = None
+        for event, elem in ElementTree.iterparse(source, events=("start", "end")):
+            if root is None:
+                root = elem
+            if event != "end" or elem.tag != "host":
+                continue
+            times_elem = elem.find("times")
+            if rtt_list is not None and times_elem is not None and times_elem.get("srtt", "").isdigit() and \
+                    times_elem.get("srtt") != "0":
+                rtt_list.append(int(times_elem.get("srtt")))
+            for record in cls.parse_host(elem):
+                yield record
+            elem.clear()
+            root.clear()
+
+
+class RateController(object):
+    """
+    Tune the nmap parallelism, host group and timeouts of the next shard from the shards finished before,
+    the loss signals are the hosts skipped by host timeout and the send delay increased by dropped probes,
+    the max rtt timeout follows the p95 of the smoothed rtt reported in the xml output
+    """
+    timeout_pattern = re.compile(r"Skipping host \S+ due to host timeout")
+    drop_pattern = re.compile(r"due to \d+ out of \d+ dropped probes")
+
+    def __init__(self, proto, is_adaptive, loss_high, loss_low):
+        self.proto = proto
+        self.is_adaptive = is_adaptive
+        self.loss_high = loss_high
+        self.loss_low = loss_low
+        self.option_dict = dict(GlobalConfig.rate_option_dict, max_rtt_timeout=None)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def clamp(key, value):
+        low, high = GlobalConfig.rate_bound_dict[key]
+        return int(min(max(value, low), high))
+
+    def get_option(self):
+        with self.lock:
+            option_dict = dict(self.option_dict)
+        max_rtt_timeout = option_dict.pop("max_rtt_timeout")
+        option_dict["rtt_option"] = "--max-rtt-timeout {}ms".format(max_rtt_timeout) if max_rtt_timeout else ""
+        return option_dict
+
+    def feedback(self, host_count, output, rtt_list):
+        """
+        :param host_count: int, the count of ip in the finished shard
+        :param output: string, the stdout of nmap
+        :param rtt_list: list, the smoothed rtt in microseconds of the hosts answered
+        """
+        if not self.is_adaptive or not host_count:
+            return
+        timeout_count = len(self.timeout_pattern.findall(output))
+        drop_count = len(self.drop_pattern.findall(output))
+        loss_rate = (timeout_count + drop_count) / float(host_count)
+        with self.lock:
+            option_dict = self.option_dict
+            if loss_rate > self.loss_high:
+                decision = "slow down"
+                option_dict["parallelism"] = self.clamp("parallelism", option_dict["parallelism"] // 2)
+                option_dict["hostgroup"] = self.clamp("hostgroup", option_dict["hostgroup"] // 2)
+                if timeout_count:
+                    option_dict["host_timeout"] = self.clamp("host_timeout", option_dict["host_timeout"] * 1.5)
+            elif loss_rate <= self.loss_low:
+                decision = "speed up"
+                option_dict["parallelism"] = self.clamp("parallelism", option_dict["parallelism"] * 1.5)
+                option_dict["hostgroup"] = self.clamp("hostgroup", option_dict["hostgroup"] * 2)
+            else:
+                decision = "hold"
+            p95_rtt = None
+            if rtt_list:
+                p95_rtt = sorted(rtt_list)[min(len(rtt_list) - 1, int(len(rtt_list) * 0.95))] / 1000.0
+                option_dict["max_rtt_timeout"] = self.clamp("max_rtt_timeout", p95_rtt * 3)
+            print("rate controller {} {}: hosts:{}, host timeout:{}, dropped probes:{}, loss rate:{:.3f}, "
+                  "p95 rtt(ms):{}, next option:{}".format(self.proto, decision, host_count, timeout_count, drop_count,
+                                                          loss_rate, p95_rtt, option_dict))
+
+
+class ConnectScanner(object):
+    """Probe every (ip, port) pair with an asyncio tcp connect, no root and no nmap binary required"""
+    proto = "tcp"
+    # the fd kept for the log, the sqlite and the nmap pipes when the concurrency is capped by the fd limit
+    fd_reserve = 64
+    error_retries = 3
+    retry_delay = 0.5
+
+    def __init__(self, port_list, concurrency, timeout):
+        self.port_list = sorted(set(int(port) for port in port_list))
+        self.concurrency = self.cap_concurrency(concurrency)
+        self.timeout = timeout
+        self.error_count = 0
+
+    @classmethod
+    def get_fd_budget(cls):
+        """:return: int, the count of socket can be opened at the same time, None without the fd limit"""
+        soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft_limit == resource.RLIM_INFINITY:
+            return None
+        return max(soft_limit - cls.fd_reserve, soft_limit // 2, 1)
+
+    @classmethod
+    def cap_concurrency(cls, concurrency):
+        fd_budget = cls.get_fd_budget()
+        if fd_budget is None or concurrency <= fd_budget:
+            return concurrency
+        print("the concurrency:{} exceeds the fd limit, use:{}".format(concurrency, fd_budget))
+        return fd_budget
+
+    async def probe(self, semaphore, ip, port):
+        """
+        Only the refused connection and the timeout mean the port is not open,
+        the other OSError(EMFILE, ENOBUFS, EADDRNOTAVAIL...) is the failure of the scanner and is retried
+        """
+        try:
+            for retry in range(self.error_retries + 1):
+                try:
+                    _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), self.timeout)
+                    break
+                except (ConnectionRefusedError, asyncio.TimeoutError):
+                    return ip, port, False
+                except OSError as e:
+                    if retry == self.error_retries:
+                        self.error_count += 1
+                        print("connect {}:{} failed after {} retries, the port is unknown, err:{}".format(
+                            ip, port, self.error_retries, e))
+                        return ip, port, False
+                    await asyncio.sleep(self.retry_delay * (retry + 1))
+        finally:
+            semaphore.release()
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return ip, port, True
+
+    async def scan_async(self, ip_list):
+        open_port_dict = defaultdict(list)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        all_task = list()
+        for ip in ip_list:
+            for port in self.port_list:
+                await semaphore.acquire()
+                all_task.append(asyncio.ensure_future(self.probe(semaphore, ip, port)))
+        for ip, port, is_open in await asyncio.gather(*all_task):
+            if is_open:
+                open_port_dict[ip].append(port)
+        return open_port_dict
+
+    def port_record(self, ip, port):
+        try:
+            service = socket.getservbyport(port, self.proto)
+        except OSError:
+            service = ""
+        return PortRecord(ip, port, "open", self.proto, "", service, "", "")
+
+    def scan(self, ip_list):
+        """
+        :return: dict, {ip: [row, ...]}, the row is the same as PortRecord.to_row
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            open_port_dict = loop.run_until_complete(self.scan_async(ip_list))
+        finally:
+            loop.close()
+        if self.error_count:
+            print("the {} scan of {} (ip, port) failed by the local error and is reported as not open, "
+                  "lower the connect_concurrency".format(self.proto, self.error_count))
+        return {ip: [self.port_record(ip, port).to_row() for port in open_port_dict.get(ip, list())] for ip in ip_list}
+
+
+class UdpProbeProtocol(asyncio.DatagramProtocol):
+    def __init__(self, loop):
+        self.future = loop.create_future()
+
+    def datagram_received(self, data, addr):
+        if not self.future.done():
+            self.future.set_result(True)
+
+    def error_received(self, exc):
+        # the icmp port unreachable is reported as ConnectionRefusedError
+        if not self.future.done():
+            self.future.set_result(False)
+
+
+class UdpProber(ConnectScanner):
+    """Send the protocol specific payload to every (ip, udp port) pair, the port answered is open"""
+    proto = "udp"
+    payload_dict = {
+        # dns: query version.bind TXT CH
+        53: b"\x12\x34\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x07version\x04bind\x00\x00\x10\x00\x03",
+        # tftp: read request
+        69: b"\x00\x01scan_port\x00octet\x00",
+        # ntp: version 3 client request
+        123: b"\x1b" + b"\x00" * 47,
+        # netbios: node status request
+        137: b"\x80\xf0\x00\x10\x00\x01\x00\x00\x00\x00\x00\x00\x20" + b"CKAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA" +
+             b"\x00\x00\x21\x00\x01",
+        # snmp: v2c get-request sysDescr.0 with community public
+        161: b"\x30\x29\x02\x01\x01\x04\x06public\xa0\x1c\x02\x04\x00\x00\x00\x01\x02\x01\x00\x02\x01\x00"
+             b"\x30\x0e\x30\x0c\x06\x08\x2b\x06\x01\x02\x01\x01\x01\x00\x05\x00",
+        # ssdp: m-search
+        1900: b"M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nMAN: \"ssdp:discover\"\r\nMX: 1\r\n"
+              b"ST: ssdp:all\r\n\r\n",
+        # memcached: stats
+        11211: b"\x00\x01\x00\x00\x00\x01\x00\x00stats\r\n",
+    }
+    default_payload = b"\r\n"
+
+    def __init__(self, port_list, concurrency, timeout, retries):
+        super(UdpProber, self).__init__(port_list, concurrency, timeout)
+        self.retries = retries
+
+    async def probe(self, semaphore, ip, port):
+        loop = asyncio.get_event_loop()
+        for retry in range(self.error_retries + 1):
+            try:
+                transport, protocol = await loop.create_datagram_endpoint(lambda: UdpProbeProtocol(loop),
+                                                                          remote_addr=(ip, port))
+                break
+            except OSError as e:
+                # the udp socket can not be opened, the failure of the scanner as ConnectScanner.probe
+                if retry == self.error_retries:
+                    self.error_count += 1
+                    print("open udp socket to {}:{} failed after {} retries, the port is unknown, err:{}".format(
+                        ip, port, self.error_retries, e))
+                    semaphore.release()
+                    return ip, port, False
+                await asyncio.sleep(self.retry_delay * (retry + 1))
+        try:
+            payload = self.payload_dict.get(port, self.default_payload)
+            for _ in range(self.retries):
+                transport.sendto(payload)
+                try:
+                    return ip, port, await asyncio.wait_for(asyncio.shield(protocol.future), self.timeout)
+                except asyncio.TimeoutError:
+                    continue
+            return ip, port, False
+        finally:
+            transport.close()
+            semaphore.release()
+
+
+class ExcelWriter(object):
+    """Collect all sheets of one run and write them once with the write-only(streaming) workbook of openpyxl"""
+
+    def __init__(self, path):
+        self.path = path
+        self.sheet_dict = dict()
+
+    def add_sheet(self, sheet_name, title, row_iter):
+        self.sheet_dict[sheet_name] = (title, row_iter)
+
+    def save(self):
+        work_book = openpyxl.Workbook(write_only=True)
+        for sheet_name, (title, row_iter) in self.sheet_dict.items():
+            table = work_book.create_sheet(sheet_name)
+            table.append(title)
+            for row in row_iter:
+                table.append(row)
+        work_book.save(self.path)
+
+
 # noinspection PyUnresolvedReferences
 class BaseInstance(object):
     def __init__(self, base_client, config, credentials, endpoint):
@@ -126,6 +539,28 @@ class BaseInstance(object):
         ret = show_infos_method(show_infos_req)
         return ret.to_dict()
 
+    def next_marker(self, response_dict, item_list, limit):
+        return None
+
+    def iter_infos(self, limit):
+        """
+        Follow the marker page by page and yield the item as soon as its page arrives
+        :param limit: int, the size of one page
+        :return: generator, the item of parse_response_data
+        """
+        marker = None
+        while True:
+            page_kwargs = {"limit": limit}
+            if marker:
+                page_kwargs["marker"] = marker
+            response_dict = self.show_infos(**page_kwargs)
+            item_list = self.parse_response_data(response_dict)
+            for item in item_list:
+                yield item
+            marker = self.next_marker(response_dict, item_list, limit)
+            if not item_list or not marker:
+                break
+
 
 class EipInstanceV2(BaseInstance):
     def __init__(self, *args, **kwargs):
@@ -137,6 +572,11 @@ class EipInstanceV2(BaseInstance):
     def parse_response_data(self, response_dict):
         return response_dict['publicips']
 
+    def next_marker(self, response_dict, item_list, limit):
+        if len(item_list) < limit:
+            return None
+        return item_list[-1]["id"]
+
 
 class EipInstanceV3(BaseInstance):
     def __init__(self, *args, **kwargs):
@@ -148,6 +588,590 @@ class EipInstanceV3(BaseInstance):
     def parse_response_data(self, response_dict):
         return response_dict['publicips']
 
+    def next_marker(self, response_dict, item_list, limit):
+        page_info = response_dict.get("page_info") or dict()
+        return page_info.get("next_marker")
+
+
+class IpSet(object):
+    """Compact set of ip addresses, the ipv4 address is kept as one bit of a 8KB bitmap allocated per /16"""
+
+    def __init__(self):
+        self.bitmap_dict = dict()
+        self.ipv6_set = set()
+        self.count = 0
+
+    def add(self, ip_int, version=4):
+        """
+        :return: bool, True if the ip is not in the set before
+        """
+        if version != 4:
+            if ip_int in self.ipv6_set:
+                return False
+            self.ipv6_set.add(ip_int)
+            self.count += 1
+            return True
+        bitmap = self.bitmap_dict.get(ip_int >> 16)
+        if bitmap is None:
+            bitmap = self.bitmap_dict[ip_int >> 16] = bytearray(8192)
+        index, mask = (ip_int & 0xffff) >> 3, 1 << (ip_int & 0x7)
+        if bitmap[index] & mask:
+            return False
+        bitmap[index] |= mask
+        self.count += 1
+        return True
+
+    def __len__(self):
+        return self.count
+
+
+class TargetReader(object):
+    """Read the targets line by line, expand the cidr and range lazily, and yield every address only once"""
+    separator_pattern = re.compile(r"[\s,;]+")
+    # an ipv6 /64 is 2**64 targets, the larger ipv6 network or range is rejected
+    max_ipv6_count = 65536
+
+    @classmethod
+    def iter_token(cls, token):
+        """
+        :param token: string, 1.1.1.1 / 1.1.1.0/24 / 1.1.1.1-1.1.1.9 / 1.1.1.1-9
+        :return: generator, tuple of (version, int of ip)
+        :raise ValueError: the invalid token, the reversed or mixed version range, or the too large ipv6 target
+        """
+        if "/" in token:
+            network = ipaddress.ip_network(token, strict=False)
+            if network.num_addresses > 2 and network.version == 4:
+                start, end = int(network.network_address) + 1, int(network.broadcast_address) - 1
+            else:
+                start, end = int(network.network_address), int(network.broadcast_address)
+            version = network.version
+        elif "-" in token:
+            start_str, end_str = token.split("-", 1)
+            start_ip = ipaddress.ip_address(start_str)
+            if "." in end_str or ":" in end_str:
+                end_ip = ipaddress.ip_address(end_str)
+            else:
+                end_ip = ipaddress.ip_address(start_str.rsplit(".", 1)[0] + "." + end_str)
+            if start_ip.version != end_ip.version:
+                raise ValueError("the range mixes ipv{} and ipv{}".format(start_ip.version, end_ip.version))
+            if start_ip > end_ip:
+                raise ValueError("the start of the range is greater than the end")
+            start, end, version = int(start_ip), int(end_ip), start_ip.version
+        else:
+            ip = ipaddress.ip_address(token)
+            start, end, version = int(ip), int(ip), ip.version
+        if version == 6 and end - start + 1 > cls.max_ipv6_count:
+            raise ValueError("the ipv6 target has {} addresses, more than {}".format(end - start + 1,
+                                                                                   cls.max_ipv6_count))
+        for ip_int in range(start, end + 1):
+            yield version, ip_int
+
+    @classmethod
+    def iter_ip(cls, line_iter):
+        """
+        :param line_iter: iterable, the lines of ip text, # starts a comment
+        :return: generator, the normalized and deduplicated ip string
+        """
+        ip_set = IpSet()
+        for line in line_iter:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            for token in cls.separator_pattern.split(line):
+                if not token:
+                    continue
+                try:
+                    for version, ip_int in cls.iter_token(token):
+                        if ip_set.add(ip_int, version):
+                            # ip_address would take the ipv6 below 2**32 as ipv4, ::1 -> 0.0.0.1
+                            yield str(ipaddress.IPv6Address(ip_int)) if version == 6 else \
+                                socket.inet_ntoa(ip_int.to_bytes(4, "big"))
+                except ValueError as e:
+                    print("skip the invalid target:{}, err:{}".format(token, e))
+
+    @staticmethod
+    def iter_batch(ip_iter, batch_size):
+        batch = list()
+        for ip in ip_iter:
+            batch.append(ip)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = list()
+        if batch:
+            yield batch
+
+
+class ScanPlanner(object):
+    """Merge the targets of all accounts into one deduplicated target set, and remember the owners of every ip"""
+
+    def __init__(self):
+        self.owner_dict = dict()
+        self.owner_ip_dict = dict()
+
+    def add(self, ip, owner):
+        owner_list = self.owner_dict.setdefault(ip, list())
+        if owner in owner_list:
+            return
+        owner_list.append(owner)
+        self.owner_ip_dict.setdefault(owner, list()).append(ip)
+
+    @property
+    def ip_list(self):
+        return list(self.owner_dict.keys())
+
+    def get_owner_list(self):
+        return list(self.owner_ip_dict.keys())
+
+    def get_ip_list(self, owner):
+        return self.owner_ip_dict.get(owner, list())
+
+    def split_result(self, ret_dict, owner):
+        """Fan the result of the global scan back out to one owner"""
+        return {ip: ret_dict[ip] for ip in self.get_ip_list(owner) if ip in ret_dict}
+
+
+class ScanState(object):
+    """The last scan result and port fingerprint of every ip persisted on disk, used for the incremental scan"""
+
+    def __init__(self, path, window_days):
+        self.path = path
+        self.window_days = window_days
+        self.state_dict = self.load()
+        # the ips updated by the scan of this run, the others only carry the result of an earlier run
+        self.scanned_ip_set = set()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return dict()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print("load scan state:{} failed, err:{}".format(self.path, e))
+            return dict()
+
+    def save(self):
+        temp_path = "{}.tmp".format(self.path)
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state_dict, f)
+        os.replace(temp_path, self.path)
+
+    @staticmethod
+    def get_fingerprint(port_list):
+        # only port, state, proto, service and version, the reason and ttl change from run to run
+        content = json.dumps(sorted(row[:5] for row in port_list))
+        return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+    def get_slot(self, ip):
+        return int(hashlib.sha1(ip.encode("utf-8")).hexdigest(), 16) % self.window_days
+
+    def select(self, ip_list, now=None):
+        """
+        The new ip and the ip not scanned within the window are scanned at once,
+        the other ips are rescanned on the day of their slot, so every day only rescans about 1/window_days of them
+        :return: tuple, (the ip list need to scan, the ip list use the last result)
+        """
+        now = now or time.time()
+        today_slot = int(now // 86400) % self.window_days
+        scan_list, cached_list = list(), list()
+        for ip in ip_list:
+            state_item = self.state_dict.get(ip)
+            if state_item is None or now - state_item["scan_time"] >= self.window_days * 86400:
+                scan_list.append(ip)
+            elif self.get_slot(ip) == today_slot:
+                scan_list.append(ip)
+            else:
+                cached_list.append(ip)
+        return scan_list, cached_list
+
+    def update(self, tcp_ret_dict, udp_ret_dict, all_port, now=None):
+        now = now or time.time()
+        for ip, port_list in all_port.items():
+            fingerprint = self.get_fingerprint(port_list)
+            state_item = self.state_dict.get(ip) or dict()
+            if state_item.get("fingerprint") != fingerprint:
+                state_item["change_time"] = now
+            state_item.update({
+                "scan_time": now,
+                "fingerprint": fingerprint,
+                "tcp": tcp_ret_dict.get(ip, list()),
+                "udp": udp_ret_dict.get(ip, list()),
+                "all": port_list,
+            })
+            self.state_dict[ip] = state_item
+        self.scanned_ip_set.update(all_port.keys())
+
+    def get_result(self, ip):
+        state_item = self.state_dict[ip]
+        return state_item["tcp"], state_item["udp"], state_item["all"]
+
+
+class ScanHistory(object):
+    """Append the result of every run to a sqlite store, so the history of an ip or a port can be queried"""
+    create_sql_list = [
+        "CREATE TABLE IF NOT EXISTS scan_result (id INTEGER PRIMARY KEY AUTOINCREMENT, ip TEXT, port INTEGER, "
+        "proto TEXT, state TEXT, banner TEXT, account TEXT, scan_time INTEGER)",
+        "CREATE INDEX IF NOT EXISTS scan_result_ip ON scan_result (ip, port)",
+        "CREATE INDEX IF NOT EXISTS scan_result_port ON scan_result (port, scan_time)",
+        "CREATE INDEX IF NOT EXISTS scan_result_time ON scan_result (scan_time)",
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        with closing(self.connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            for create_sql in self.create_sql_list:
+                conn.execute(create_sql)
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def append(self, scan_time, account, all_port, server_info):
+        """
+        :param all_port: dict, {ip: [row, ...]}, the row is the same as PortRecord.to_row
+        :param server_info: dict, {ip: [[port, server_info], ...]}, the banner of the tcp port
+        :return: int, the count of row appended
+        """
+        banner_dict = {(ip, str(port)): banner for ip, server_list in server_info.items()
+                       for port, banner in server_list}
+        row_list = list()
+        for ip, port_list in all_port.items():
+            for row in port_list:
+                state, proto = row[1], row[2]
+                banner = banner_dict.get((ip, str(row[0]))) if proto == "tcp" else None
+                row_list.append((ip, int(row[0]), proto, state, banner, account, scan_time))
+        with closing(self.connect()) as conn:
+            with conn:
+                conn.executemany("INSERT INTO scan_result (ip, port, proto, state, banner, account, scan_time) "
+                                 "VALUES (?, ?, ?, ?, ?, ?, ?)", row_list)
+        return len(row_list)
+
+    def query(self, sql, params):
+        with closing(self.connect()) as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def get_first_open(self, ip, port, proto="tcp"):
+        """:return: int, the timestamp the port is first seen open on the ip, or None"""
+        return self.query("SELECT MIN(scan_time) FROM scan_result WHERE ip = ? AND port = ? AND proto = ? "
+                          "AND state = 'open'", (ip, port, proto))[0][0]
+
+    def list_exposed_ip(self, port, since, proto="tcp"):
+        """:return: list, (ip, account, the last scan time) of the ip exposing the port since the timestamp"""
+        return self.query("SELECT ip, account, MAX(scan_time) FROM scan_result WHERE port = ? AND scan_time >= ? "
+                          "AND proto = ? AND state = 'open' GROUP BY ip, account ORDER BY ip",
+                          (port, since, proto))
+
+    def list_ip_history(self, ip):
+        """:return: list, (scan_time, port, proto, state, banner, account) of every run of the ip"""
+        return self.query("SELECT scan_time, port, proto, state, banner, account FROM scan_result WHERE ip = ? "
+                          "ORDER BY scan_time, port", (ip,))
+
+
+class PortSnapshot(object):
+    """
+    The open ports of every ip of the last run, a tuple of (tcp mask, udp mask) per ip, the bit of the mask is the port,
+    so the change of thousands of ips is a few int operations
+    """
+    proto_list = ["tcp", "udp"]
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def get_mask(cls, row_list):
+        """
+        :param row_list: list, the row is the same as PortRecord.to_row
+        :return: tuple, (tcp mask, udp mask), only the open port is set, the udp scan lists closed/open|filtered too
+        """
+        tcp_mask, udp_mask = 0, 0
+        for row in row_list:
+            if row[1] != "open":
+                continue
+            if row[2] == "udp":
+                udp_mask |= 1 << int(row[0])
+            else:
+                tcp_mask |= 1 << int(row[0])
+        return tcp_mask, udp_mask
+
+    @staticmethod
+    def iter_port(mask):
+        """:return: generator, the port of every bit set in the mask"""
+        while mask:
+            low_bit = mask & -mask
+            yield low_bit.bit_length() - 1
+            mask ^= low_bit
+
+    def load(self):
+        """:return: tuple, (the time of the last run, {ip: (tcp mask, udp mask)}), the time is None without last run"""
+        if not os.path.exists(self.path):
+            return None, dict()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            print("load port snapshot:{} failed, err:{}".format(self.path, e))
+            return None, dict()
+        mask_dict = dict()
+        for ip, port_dict in snapshot["port"].items():
+            mask_list = [0, 0]
+            for index, proto in enumerate(self.proto_list):
+                for port in port_dict.get(proto, list()):
+                    mask_list[index] |= 1 << port
+            mask_dict[ip] = tuple(mask_list)
+        return snapshot["scan_time"], mask_dict
+
+    def save(self, scan_time, mask_dict):
+        temp_path = "{}.tmp".format(self.path)
+        with open(temp_path, "w", encoding="utf-8") as f:
+            # the bitmap of a high port is too sparse to dump as is, dump the ports instead
+            port_dict = {ip: {proto: list(self.iter_port(mask)) for proto, mask in zip(self.proto_list, mask_tuple)}
+                         for ip, mask_tuple in mask_dict.items()}
+            json.dump({"scan_time": scan_time, "port": port_dict}, f)
+        os.replace(temp_path, self.path)
+
+    @classmethod
+    def get_high_mask(cls, config_obj):
+        """The (tcp mask, udp mask) of the high risk ports, the udp ports are high_risk_udp_port if configured"""
+        high_risk_port = config_obj["high_risk_port"]
+        high_risk_udp_port = config_obj.get("high_risk_udp_port") or high_risk_port
+        return cls.get_mask([[port, "open", "tcp"] for port in high_risk_port] +
+                            [[port, "open", "udp"] for port in high_risk_udp_port])
+
+    @classmethod
+    def diff(cls, last_mask_dict, mask_dict, high_mask):
+        """
+        Only the ips scanned in this run are compared, the ip new in this run counts from an empty port set
+        :return: list, [ip, port, proto, change, is_high_risk], the high risk change first
+        """
+        delta_list = list()
+        for ip, mask_tuple in mask_dict.items():
+            last_mask_tuple = last_mask_dict.get(ip, (0, 0))
+            if last_mask_tuple == mask_tuple:
+                continue
+            for proto, mask, last_mask, proto_high_mask in zip(cls.proto_list, mask_tuple, last_mask_tuple, high_mask):
+                for change, change_mask in (("opened", mask & ~last_mask), ("closed", last_mask & ~mask)):
+                    for port in cls.iter_port(change_mask):
+                        delta_list.append([ip, port, proto, change, bool(proto_high_mask >> port & 1)])
+        delta_list.sort(key=lambda item: not item[4])
+        return delta_list
+
+
+class ScanJournal(object):
+    """Append-only checkpoint journal, one json line per finished shard, so that a broken run can be resumed"""
+
+    def __init__(self, path):
+        self.path = path
+        self.done_dict = {"tcp": dict(), "udp": dict()}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    journal_item = json.loads(line)
+                except ValueError:
+                    print("skip the broken line of scan journal:{}".format(line.strip()))
+                    continue
+                self.done_dict[journal_item["proto"]].update(journal_item["result"])
+        print("load scan journal, the count of finished tcp ip:{}, udp ip:{}".format(
+            len(self.done_dict["tcp"]), len(self.done_dict["udp"])))
+
+    def append(self, proto, host_dict):
+        self.done_dict[proto].update(host_dict)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"proto": proto, "result": host_dict}))
+            f.write("\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def clear(self):
+        self.done_dict = {"tcp": dict(), "udp": dict()}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ShardQueue(object):
+    """
+    The sqlite backed work queue shared by the coordinator and the workers,
+    put the db file on a shared file system when the workers run on other nodes
+    """
+    coordinator = "coordinator"
+    create_sql = "CREATE TABLE IF NOT EXISTS shard (id INTEGER PRIMARY KEY AUTOINCREMENT, proto TEXT, ip_list TEXT, " \
+                 "status TEXT, worker TEXT, claim_time REAL, result TEXT, is_collected INTEGER DEFAULT 0)"
+
+    def __init__(self, path, lease, poll_interval, stall_timeout=GlobalConfig.queue_stall_timeout):
+        self.path = path
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.stall_timeout = stall_timeout
+        with closing(self.connect()) as conn:
+            conn.execute(self.create_sql)
+            conn.execute("CREATE INDEX IF NOT EXISTS shard_status ON shard (status)")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def reset(self, job_list):
+        with closing(self.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM shard")
+            conn.executemany("INSERT INTO shard (proto, ip_list, status) VALUES (?, ?, 'pending')",
+                             [(proto, json.dumps(shard)) for proto, shard in job_list])
+            conn.execute("COMMIT")
+
+    def claim(self, worker):
+        """
+        Claim the first pending shard, or the running shard whose worker has not finished it within the lease
+        :return: tuple, (id, proto, ip_list) or None
+        """
+        with closing(self.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT id, proto, ip_list FROM shard WHERE status = 'pending' OR "
+                               "(status = 'running' AND claim_time < ?) ORDER BY id LIMIT 1",
+                               (time.time() - self.lease,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE shard SET status = 'running', worker = ?, claim_time = ? WHERE id = ?",
+                             (worker, time.time(), row[0]))
+            conn.execute("COMMIT")
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def finish(self, shard_id, host_dict, is_collected=0):
+        with closing(self.connect()) as conn:
+            conn.execute("UPDATE shard SET status = 'done', result = ?, is_collected = ? WHERE id = ?",
+                         (json.dumps(host_dict), is_collected, shard_id))
+
+    def count_shard(self):
+        """:return: int, the count of shard on the queue, done or not, 0 before the coordinator puts the jobs"""
+        with closing(self.connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM shard").fetchone()[0]
+
+    def count_claimed(self):
+        """:return: int, the count of shard claimed by the workers, the shard run by the coordinator is excluded"""
+        with closing(self.connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM shard WHERE status != 'pending' AND worker != ?",
+                                (self.coordinator,)).fetchone()[0]
+
+    def dispatch(self, job_list, run_job_list):
+        """
+        Put the jobs on the queue and wait for the workers, if no shard is claimed or done within the stall timeout,
+        e.g. no worker is alive, the coordinator claims all the remaining shards and runs them by itself
+        :param run_job_list: function, run_job_list(job_list) yields (proto, ip_list, host_dict) of every job
+        :return: generator, (proto, ip_list, host_dict) of every shard as soon as it is done
+        """
+        self.reset(job_list)
+        print("put {} shards on the queue:{}, waiting for the workers...".format(len(job_list), self.path))
+        collected_count, claimed_count, progress_time = 0, 0, time.time()
+        while collected_count < len(job_list):
+            with closing(self.connect()) as conn:
+                row_list = conn.execute("SELECT id, proto, ip_list, result, worker FROM shard "
+                                        "WHERE status = 'done' AND is_collected = 0").fetchall()
+                conn.executemany("UPDATE shard SET is_collected = 1 WHERE id = ?", [(row[0],) for row in row_list])
+            for _, proto, ip_list, result, worker in row_list:
+                collected_count += 1
+                if worker != self.coordinator:
+                    progress_time = time.time()
+                yield proto, json.loads(ip_list), json.loads(result)
+            if row_list:
+                continue
+            current_claimed_count = self.count_claimed()
+            if current_claimed_count != claimed_count:
+                claimed_count, progress_time = current_claimed_count, time.time()
+            elif time.time() - progress_time >= self.stall_timeout:
+                # the shards of one proto never overlap, so (proto, ip_list) finds the id of the shard
+                shard_id_dict = dict()
+                shard_item = self.claim(self.coordinator)
+                while shard_item is not None:
+                    shard_id, proto, shard = shard_item
+                    shard_id_dict[(proto, tuple(shard))] = shard_id
+                    shard_item = self.claim(self.coordinator)
+                if shard_id_dict:
+                    print("no worker progress for {}s, the coordinator scans the remaining {} shards by itself".format(
+                        self.stall_timeout, len(shard_id_dict)))
+                    for proto, shard, host_dict in run_job_list([(proto, list(shard))
+                                                                 for proto, shard in shard_id_dict.keys()]):
+                        self.finish(shard_id_dict[(proto, tuple(shard))], host_dict, is_collected=1)
+                        collected_count += 1
+                        yield proto, shard, host_dict
+                    continue
+            time.sleep(self.poll_interval)
+
+
+class ProjectCache(object):
+    """The project list of every ak persisted on disk, keyed by the hash of ak and expired after ttl seconds"""
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+
+    @staticmethod
+    def get_key(ak):
+        return hashlib.sha256(ak.encode("utf-8")).hexdigest()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return dict()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print("load project cache:{} failed, err:{}".format(self.path, e))
+            return dict()
+
+    def get(self, ak):
+        cache_item = self.load().get(self.get_key(ak))
+        if not cache_item or time.time() - cache_item["update_time"] >= self.ttl:
+            return None
+        return cache_item["project_info"]
+
+    def set(self, ak, project_info):
+        cache_dict = self.load()
+        cache_dict[self.get_key(ak)] = {"update_time": time.time(), "project_info": project_info}
+        temp_path = "{}.tmp".format(self.path)
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(cache_dict, f)
+        os.replace(temp_path, self.path)
+
+
+class StageTimer(object):
+    """Record the wall time of every stage of one run, and the peak rss of the process and the nmap children"""
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.stage_dict = dict()
+
+    @contextmanager
+    def stage(self, name):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start_time)
+
+    def record(self, name, cost):
+        self.stage_dict[name] = self.stage_dict.get(name, 0) + cost
+
+    def set_max(self, name, cost):
+        self.stage_dict[name] = max(self.stage_dict.get(name, 0), cost)
+
+    def get_report(self):
+        # ru_maxrss is in kilobytes on linux
+        return {
+            "total": round(time.time() - self.start_time, 3),
+            "stage": {name: round(cost, 3) for name, cost in self.stage_dict.items()},
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "children_peak_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        }
+
+    def output(self, path=None):
+        report = self.get_report()
+        print("stage cost:{}".format(json.dumps(report)))
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+
 
 class HuaweiCloud(object):
     @staticmethod
@@ -157,15 +1181,22 @@ class HuaweiCloud(object):
         return config
 
     @staticmethod
-    def get_project_zone(ak, sk):
+    def get_project_zone(ak, sk, project_cache=None, refresh=False):
+        if project_cache is not None and not refresh:
+            list_data = project_cache.get(ak)
+            if list_data is not None:
+                print("[get_project_zone] hit project cache total:{}".format(len(list_data)))
+                return list_data
         list_data = list()
         try:
             credentials = GlobalCredentials(ak, sk)
             config = HuaweiCloud.get_iam_config()
-            client = IamClient.new_builder().with_http_config(config) \
-                .with_credentials(credentials) \
-                .with_region(IamRegion.value_of("ap-southeast-1")) \
-                .build()
+            builder = IamClient.new_builder().with_http_config(config).with_credentials(credentials)
+            if os.environ.get(EndPoint.override_env):
+                builder = builder.with_endpoint(os.environ[EndPoint.override_env])
+            else:
+                builder = builder.with_region(IamRegion.value_of("ap-southeast-1"))
+            client = builder.build()
             request = KeystoneListProjectsRequest()
             response = client.keystone_list_projects(request)
             for info in response.projects:
@@ -173,6 +1204,8 @@ class HuaweiCloud(object):
                     continue
                 list_data.append({"zone": info.name, "project_id": info.id})
             print("[get_project_zone] collect project total:{}".format(len(list_data)))
+            if project_cache is not None and list_data:
+                project_cache.set(ak, list_data)
             return list_data
         except exceptions.ClientRequestException as e:
             print("ak:{}, sk:{} get project zone failed".format(ak[:5], sk[:5]))
@@ -185,12 +1218,26 @@ class EipTools(object):
     def __init__(self, *args, **kwargs):
         super(EipTools, self).__init__(*args, **kwargs)
 
+    rate_controller_dict = dict()
+    rate_controller_lock = threading.Lock()
+
     @classmethod
     def get_eip_config(cls):
         config = HttpConfig.get_default_config()
         config.ignore_ssl_verification = True
         return config
 
+    @classmethod
+    def read_all_ip(cls, path):
+        """
+        :return: generator, the deduplicated ip of the text file, cidr and range are expanded lazily
+        """
+        if not os.path.exists(path):
+            raise Exception("file path is not exist")
+        with open(path, "r") as file:
+            for ip in TargetReader.iter_ip(file):
+                yield ip
+
     @classmethod
     def output_txt(cls, eip_info_list):
         with open(GlobalConfig.txt_path, "w") as f:
@@ -204,54 +1251,265 @@ class EipTools(object):
             return f.readlines()
 
     @classmethod
-    def read_ip_result_txt(cls):
-        with open(GlobalConfig.ip_result_path, "r") as f:
-            content = f.readlines()
-        return content
+    def output_target_txt(cls, ip_list, path):
+        with open(path, "w") as f:
+            f.write("\n".join(ip_list))
+            f.write("\n")
 
-    # noinspection PyUnresolvedReferences
     @classmethod
-    def parse_tcp_result_txt_all(cls, tcp_content_list):
-        host_data = defaultdict(list)
-        for info in tcp_content_list:
-            if "Host:" in info and "Ports:":
-                ret_list = list()
-                info_list = info.split("Ports:")
-                ip = re.match(r"Host: (.*?)\(\)", info_list[0])
-                if not ip:
-                    continue
-                ip = ip.groups()[0].strip()
-                infor_str_list = info_list[1].split()
-                for infor_str_temp in infor_str_list:
-                    if "/" in infor_str_temp:
-                        for infor_str_temp_data in infor_str_temp.split(","):
-                            port = re.match(r"(.*?)///", infor_str_temp_data.strip())
-                            if not port:
-                                continue
-                            ret_list.append(port.groups()[0].strip())
-                host_data[ip] = ret_list
-        return host_data
-
-    @classmethod
-    def parse_result_txt(cls, config_obj, tcp_content_list):
-        high_port, all_port = list(), list()
-        for info in tcp_content_list:
-            if "Host:" in info and "Ports:" in info:
-                info_list = info.split("Ports:")
-                print(info_list)
-                infor_str_list = info_list[1].split()
-                for infor_str_temp in infor_str_list:
-                    if "/" in infor_str_temp:
-                        for infor_str_temp_data in infor_str_temp.split(","):
-                            port = re.match(r"(.*?)///", infor_str_temp_data.strip())
-                            if not port:
-                                continue
-                            port_str = port.groups()[0].strip()
-                            port_content = list(filter(lambda x: x != "", port_str.split('/')))
-                            if config_obj.get("high_risk_port") is not None and int(port_content[0]) in config_obj["high_risk_port"]:
-                                high_port.append(port_content)
-                            all_port.append(port_content)
-        return high_port, all_port
+    def iter_result(cls, path, scan_output="grepable", rtt_list=None):
+        """:param rtt_list: list, collect the smoothed rtt of the xml output in the same pass, see XmlParser"""
+        if not os.path.exists(path) or not os.path.getsize(path):
+            return
+        if scan_output == "xml":
+            try:
+                for record in XmlParser.iter_records(path, rtt_list):
+                    yield record
+            except ElementTree.ParseError as e:
+                print("parse xml result:{} failed, err:{}".format(path, e))
+            return
+        with open(path, "r") as f:
+            for record in GrepableParser.iter_records(f):
+                yield record
+
+    @classmethod
+    def parse_result_by_host(cls, config_obj, record_iter):
+        """
+        Group the port records of one scan by host
+        :return: dict, {ip: (high_port, all_port)}
+        """
+        high_risk_port = set(int(port) for port in config_obj.get("high_risk_port") or list())
+        high_risk_udp_port = set(int(port) for port in config_obj.get("high_risk_udp_port") or list())
+        host_dict = dict()
+        for record in record_iter:
+            high_port, all_port = host_dict.setdefault(record.ip, (list(), list()))
+            row = record.to_row()
+            if record.proto == "udp" and high_risk_udp_port:
+                is_high_risk = record.port in high_risk_udp_port
+            else:
+                is_high_risk = record.port in high_risk_port
+            if is_high_risk:
+                high_port.append(row)
+            all_port.append(row)
+        return host_dict
+
+    @classmethod
+    def get_rate_controller(cls, config_obj, proto):
+        with cls.rate_controller_lock:
+            if proto not in cls.rate_controller_dict:
+                cls.rate_controller_dict[proto] = RateController(
+                    proto, config_obj.get("adaptive_rate", GlobalConfig.adaptive_rate),
+                    config_obj.get("adaptive_loss_high") or GlobalConfig.adaptive_loss_high,
+                    config_obj.get("adaptive_loss_low") or GlobalConfig.adaptive_loss_low)
+            return cls.rate_controller_dict[proto]
+
+    @classmethod
+    def scan_shard(cls, config_obj, proto, shard):
+        """
+        Run one nmap job in its own work dir, so that jobs never share the target and result file
+        :return: tuple, (proto, shard, {ip: (high_port, all_port)})
+        """
+        scan_output = config_obj.get("scan_output", GlobalConfig.scan_output)
+        work_dir = tempfile.mkdtemp(prefix="scan_port_{}_".format(proto))
+        try:
+            target_path = os.path.join(work_dir, GlobalConfig.ip_target_name)
+            result_path = os.path.join(work_dir, GlobalConfig.ip_result_name_dict[scan_output])
+            cls.output_target_txt(shard, target_path)
+            port_option = ""
+            if proto == "udp" and config_obj.get("high_risk_udp_port"):
+                port_option = "-p {}".format(",".join(str(port) for port in config_obj["high_risk_udp_port"]))
+            rate_controller = cls.get_rate_controller(config_obj, proto)
+            cmd = GlobalConfig.search_cmd_dict[proto].format(output_option=GlobalConfig.output_option_dict[scan_output],
+                                                             output=result_path, target=target_path,
+                                                             port_option=port_option, **rate_controller.get_option())
+            output = cls.execute_cmd(cmd)
+            rtt_list = list()
+            host_dict = cls.parse_result_by_host(config_obj, cls.iter_result(result_path, scan_output, rtt_list))
+            rate_controller.feedback(len(shard), output, rtt_list)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        return proto, shard, host_dict
+
+    @classmethod
+    def connect_scan_ip_list(cls, config_obj, proto, ip_list):
+        """
+        Only probe the high risk tcp ports by tcp connect
+        :return: tuple, (proto, ip_list, {ip: (high_port, all_port)})
+        """
+        scanner = ConnectScanner(config_obj["high_risk_port"], cls.get_connect_concurrency(config_obj),
+                                 config_obj.get("connect_timeout") or GlobalConfig.connect_timeout)
+        print("start to connect scan, the count of ip:{}, the count of port:{}".format(len(ip_list),
+                                                                                     len(scanner.port_list)))
+        host_dict = {ip: (port_list, list(port_list)) for ip, port_list in scanner.scan(ip_list).items()}
+        return proto, ip_list, host_dict
+
+    @classmethod
+    def probe_scan_ip_list(cls, config_obj, proto, ip_list):
+        """
+        Only probe the high risk udp ports with the protocol specific payload
+        :return: tuple, (proto, ip_list, {ip: (high_port, all_port)})
+        """
+        prober = UdpProber(config_obj["high_risk_udp_port"], cls.get_connect_concurrency(config_obj),
+                           config_obj.get("udp_probe_timeout") or GlobalConfig.udp_probe_timeout,
+                           config_obj.get("udp_probe_retries") or GlobalConfig.udp_probe_retries)
+        print("start to probe udp, the count of ip:{}, the count of port:{}".format(len(ip_list),
+                                                                                  len(prober.port_list)))
+        host_dict = {ip: (port_list, list(port_list)) for ip, port_list in prober.scan(ip_list).items()}
+        return proto, ip_list, host_dict
+
+    @classmethod
+    def skip_scan_ip_list(cls, config_obj, proto, ip_list):
+        """The connect engine can not scan udp without root, so the udp result is empty unless udp_engine is probe"""
+        return proto, ip_list, dict()
+
+    @classmethod
+    def get_connect_concurrency(cls, config_obj):
+        """
+        The tcp connect and the udp probe run at the same time, so they share connect_concurrency,
+        which is capped by the fd limit first
+        """
+        concurrency = config_obj.get("connect_concurrency") or GlobalConfig.connect_concurrency
+        concurrency = ConnectScanner.cap_concurrency(concurrency)
+        socket_proto_count = int(config_obj.get("scan_engine", GlobalConfig.scan_engine) == "connect") + \
+            int(config_obj.get("udp_engine", GlobalConfig.udp_engine) == "probe")
+        return max(concurrency // max(socket_proto_count, 1), 1)
+
+    @classmethod
+    def get_native_scan_dict(cls, config_obj):
+        native_scan_dict = dict()
+        if config_obj.get("scan_engine", GlobalConfig.scan_engine) == "connect":
+            native_scan_dict["tcp"] = cls.connect_scan_ip_list
+            native_scan_dict["udp"] = cls.skip_scan_ip_list
+        if config_obj.get("udp_engine", GlobalConfig.udp_engine) == "probe":
+            native_scan_dict["udp"] = cls.probe_scan_ip_list
+        return native_scan_dict
+
+    @classmethod
+    def incremental_scan_ip_list(cls, config_obj, ip_list, scan_state, scan_journal=None, shard_queue=None,
+                                 stage_timer=None):
+        """
+        Only scan the ips selected by the scan state, and merge the last result of the others into the current view
+        :return: tuple, (tcp_ret_dict, udp_ret_dict, all_port)
+        """
+        scan_list, cached_list = scan_state.select(ip_list)
+        print("incremental scan, the count of ip need to scan:{}, the count of ip use last result:{}".format(
+            len(scan_list), len(cached_list)))
+        if scan_list:
+            scan_tcp_dict, scan_udp_dict, scan_all_port = cls.scan_ip_list(config_obj, scan_list, scan_journal,
+                                                                           shard_queue, stage_timer)
+            scan_state.update(scan_tcp_dict, scan_udp_dict, scan_all_port)
+        tcp_ret_dict, udp_ret_dict, all_port = dict(), dict(), dict()
+        for ip in ip_list:
+            tcp_ret_dict[ip], udp_ret_dict[ip], all_port[ip] = scan_state.get_result(ip)
+        return tcp_ret_dict, udp_ret_dict, all_port
+
+    @classmethod
+    def run_scan_job(cls, config_obj, proto, shard):
+        native_scan_dict = cls.get_native_scan_dict(config_obj)
+        if proto in native_scan_dict:
+            return native_scan_dict[proto](config_obj, proto, shard)
+        return cls.scan_shard(config_obj, proto, shard)
+
+    @classmethod
+    def iter_local_job(cls, config_obj, job_list):
+        """
+        The shards of a native engine run one by one on their own thread, each on its own event loop,
+        the native engines of tcp and udp split connect_concurrency, see get_connect_concurrency
+        :return: generator, (proto, shard, host_dict) of every job as soon as it is done
+        """
+        scan_worker = config_obj.get("scan_worker") or GlobalConfig.scan_worker
+        native_executor_dict = {proto: ThreadPoolExecutor(max_workers=1)
+                                for proto in cls.get_native_scan_dict(config_obj).keys()}
+        try:
+            with ThreadPoolExecutor(max_workers=scan_worker) as executor:
+                all_task = [native_executor_dict.get(proto, executor).submit(cls.run_scan_job, config_obj, proto, shard)
+                            for proto, shard in job_list]
+                for task in as_completed(all_task):
+                    yield task.result()
+        finally:
+            for native_executor in native_executor_dict.values():
+                native_executor.shutdown()
+
+    @classmethod
+    def scan_ip_list(cls, config_obj, ip_list, scan_journal=None, shard_queue=None, stage_timer=None):
+        """
+        Split the ip list into jobs, each job scans one shard of scan_batch_size for one proto,
+        the jobs run on a bounded local pool, or on the workers through the shard queue,
+        the ips already finished in the scan journal are skipped and every finished shard is appended to it,
+        the stage timer records the time from the start until the last shard of each proto is finished
+        :return: tuple, (tcp_ret_dict, udp_ret_dict, all_port)
+        """
+        proto_host_dict = {"tcp": dict(), "udp": dict()}
+        if scan_journal is not None:
+            for proto, host_dict in scan_journal.done_dict.items():
+                proto_host_dict[proto].update((ip, host_dict[ip]) for ip in ip_list if ip in host_dict)
+        batch_size = config_obj.get("scan_batch_size") or GlobalConfig.scan_batch_size
+        job_list = list()
+        for proto in proto_host_dict.keys():
+            pending_list = [ip for ip in ip_list if ip not in proto_host_dict[proto]]
+            print("the count of {} ip need to scan:{}, finished:{}".format(proto, len(pending_list),
+                                                                         len(ip_list) - len(pending_list)))
+            for index in range(0, len(pending_list), batch_size):
+                shard = pending_list[index:index + batch_size]
+                print("submit {} shard:{}-{}, the count of ip:{}".format(proto, index, index + len(shard), len(shard)))
+                job_list.append((proto, shard))
+        start_time = time.time()
+        if shard_queue is not None:
+            finished_iter = shard_queue.dispatch(job_list, lambda local_job_list: cls.iter_local_job(config_obj,
+                                                                                                    local_job_list))
+        else:
+            finished_iter = cls.iter_local_job(config_obj, job_list)
+        for proto, shard, host_dict in finished_iter:
+            print("finish {} shard, the count of ip:{}, the count of up ip:{}".format(proto, len(shard),
+                                                                                     len(host_dict)))
+            shard_dict = {ip: host_dict.get(ip, (list(), list())) for ip in shard}
+            proto_host_dict[proto].update(shard_dict)
+            if scan_journal is not None:
+                scan_journal.append(proto, shard_dict)
+            if stage_timer is not None:
+                stage_timer.set_max(proto, time.time() - start_time)
+        return cls.merge_proto_result(ip_list, proto_host_dict)
+
+    @classmethod
+    def run_queue_worker(cls, config_obj, shard_queue):
+        """
+        Claim the shards from the queue and post the parsed result back, until the queue stays idle too long,
+        the idle clock starts once the queue has any shard, done or not, so the worker waits on an empty queue
+        for a coordinator still in discovery, and exits after the idle timeout on the queue of a finished run
+        """
+        queue_idle_timeout = config_obj.get("queue_idle_timeout") or GlobalConfig.queue_idle_timeout
+        worker = "{}-{}-{}".format(socket.gethostname(), os.getpid(), threading.current_thread().name)
+        idle_start = None
+        while idle_start is None or time.time() - idle_start < queue_idle_timeout:
+            shard_item = shard_queue.claim(worker)
+            if shard_item is None:
+                if idle_start is None and shard_queue.count_shard():
+                    idle_start = time.time()
+                time.sleep(shard_queue.poll_interval)
+                continue
+            shard_id, proto, shard = shard_item
+            print("worker:{} claim {} shard:{}, the count of ip:{}".format(worker, proto, shard_id, len(shard)))
+            _, _, host_dict = cls.run_scan_job(config_obj, proto, shard)
+            shard_queue.finish(shard_id, host_dict)
+            idle_start = time.time()
+        print("worker:{} exit, the queue is idle for {}s".format(worker, queue_idle_timeout))
+
+    @classmethod
+    def run_queue_worker_pool(cls, config_obj, shard_queue):
+        scan_worker = config_obj.get("scan_worker") or GlobalConfig.scan_worker
+        with ThreadPoolExecutor(max_workers=scan_worker) as executor:
+            all_task = [executor.submit(cls.run_queue_worker, config_obj, shard_queue) for _ in range(scan_worker)]
+            for task in all_task:
+                task.result()
+
+    @classmethod
+    def merge_proto_result(cls, ip_list, proto_host_dict):
+        tcp_ret_dict, udp_ret_dict, all_port = dict(), dict(), dict()
+        for ip in ip_list:
+            tcp_ret_dict[ip], tcp_port = proto_host_dict["tcp"].get(ip, (list(), list()))
+            udp_ret_dict[ip], udp_port = proto_host_dict["udp"].get(ip, (list(), list()))
+            all_port[ip] = list(tcp_port) + list(udp_port)
+        return tcp_ret_dict, udp_ret_dict, all_port
 
     @classmethod
     def get_device_info(cls, instance_list):
@@ -268,6 +1526,18 @@ class EipTools(object):
     def parse_input_args(cls):
         par = argparse.ArgumentParser()
         par.add_argument("-config_path", "--config_path", help="The config path of object", required=False)
+        par.add_argument("-refresh_project_cache", "--refresh_project_cache", help="Ignore the cached project list",
+                         action="store_true", required=False)
+        par.add_argument("-resume", "--resume", help="Skip the ips already finished in the scan journal",
+                         action="store_true", required=False)
+        par.add_argument("-ip_file", "--ip_file", help="The path of ip text file scanned together with the accounts",
+                         required=False)
+        par.add_argument("-stage_report", "--stage_report", help="The json path of the cost of every stage",
+                         required=False)
+        par.add_argument("-role", "--role", help="Run as standalone, or coordinator/worker of the shard queue",
+                         choices=GlobalConfig.role_list, default=GlobalConfig.role_list[0], required=False)
+        par.add_argument("-queue_path", "--queue_path", help="The sqlite path of the shard queue",
+                         default=GlobalConfig.queue_path, required=False)
         args = par.parse_args()
         return args
 
@@ -282,9 +1552,20 @@ class EipTools(object):
         return content
 
     @classmethod
-    def check_config_data(cls, config_obj):
+    def check_config_data(cls, config_obj, need_account=True):
+        """:param need_account: bool, the worker of the shard queue only scans, it needs no account_info"""
         if config_obj.get("high_risk_port") is None:
             raise Exception("high_risk_port is None")
+        if config_obj.get("scan_engine", GlobalConfig.scan_engine) not in GlobalConfig.scan_engine_list:
+            raise Exception("scan_engine must be one of:{}".format(",".join(GlobalConfig.scan_engine_list)))
+        if config_obj.get("scan_output", GlobalConfig.scan_output) not in GlobalConfig.output_option_dict.keys():
+            raise Exception("scan_output must be one of:{}".format(",".join(GlobalConfig.output_option_dict.keys())))
+        if config_obj.get("udp_engine", GlobalConfig.udp_engine) not in GlobalConfig.udp_engine_list:
+            raise Exception("udp_engine must be one of:{}".format(",".join(GlobalConfig.udp_engine_list)))
+        if config_obj.get("udp_engine") == "probe" and not config_obj.get("high_risk_udp_port"):
+            raise Exception("high_risk_udp_port is None")
+        if not need_account:
+            return
         for config_temp in config_obj["account_info"]:
             if config_temp.get("ak") is None:
                 raise Exception("Ak is invalid")
@@ -297,17 +1578,65 @@ class EipTools(object):
         zone = project_temp["zone"]
         config = eip_tools.get_eip_config()
         credentials = BasicCredentials(ak, sk, project_id)
+        endpoint = EndPoint.get_endpoint(EndPoint.vpc_endpoint, zone)
         if zone in GlobalConfig.eip_v2_zone:
-            eip_instance = EipInstanceV2(EipClientV2, config, credentials, EndPoint.vpc_endpoint.format(zone))
+            eip_instance = EipInstanceV2(EipClientV2, config, credentials, endpoint)
         else:
-            eip_instance = EipInstanceV3(EipClientV3, config, credentials, EndPoint.vpc_endpoint.format(zone))
-        eip_dict = eip_instance.show_infos()
-        eip_list = eip_instance.parse_response_data(eip_dict)
+            eip_instance = EipInstanceV3(EipClientV3, config, credentials, endpoint)
+        eip_list = eip_instance.iter_infos(GlobalConfig.eip_page_limit)
         eip_ip_list = list()
         for eip_info in eip_list:
             eip_ip_list.append(eip_info['public_ip_address'])
         return eip_ip_list
 
+    def get_zone_data(self, eip_tools, project_temp, ak, sk):
+        start_time = time.time()
+        try:
+            ret_temp = self.get_data_list(eip_tools, project_temp, ak, sk)
+        except Exception as e:
+            print("Collect the zone of info:{} failed, err:{}".format(project_temp["zone"], e))
+            ret_temp = None
+        print("Collect the zone of info:{}, the count of ip:{}, cost:{:.2f}s".format(
+            project_temp["zone"], len(ret_temp or []), time.time() - start_time))
+        return ret_temp or []
+
+    def collect_zone_data(self, eip_tools, project_info, ak, sk, zone_worker):
+        """
+        Query all projects of one account concurrently, a failed zone only loses its own result
+        :return: list, the merged result of every zone in the order of project_info
+        """
+        result_list = list()
+        with ThreadPoolExecutor(max_workers=zone_worker) as executor:
+            all_task = [executor.submit(self.get_zone_data, eip_tools, project_temp, ak, sk)
+                        for project_temp in project_info]
+            for task in all_task:
+                result_list.extend(task.result())
+        return result_list
+
+    def collect_account_ip(self, eip_tools, config_obj, scan_planner, project_cache, input_args):
+        """Collect the eip of every account and the ip file into the scan planner"""
+        for config_item in config_obj["account_info"]:
+            ak = config_item["ak"]
+            sk = config_item["sk"]
+            account = config_item["account"]
+            project_info = HuaweiCloud.get_project_zone(ak, sk, project_cache, input_args.refresh_project_cache)
+            if not project_info:
+                print("ak:{}, sk:{} get empty project info.".format(ak[:5], sk[:5]))
+                continue
+            zone_worker = config_obj.get("zone_worker") or GlobalConfig.zone_worker
+            result_list = self.collect_zone_data(eip_tools, project_info, ak, sk, zone_worker)
+            result_list = list(set(result_list))
+            print("Write the data to txt, the count of ip:{}...".format(len(result_list)))
+            if not result_list:
+                continue
+            with open("./{}.txt".format(account), "w") as f:
+                f.write("\n".join(result_list))
+            for ip in result_list:
+                scan_planner.add(ip, account)
+        if input_args.ip_file:
+            for ip in eip_tools.read_all_ip(input_args.ip_file):
+                scan_planner.add(ip, GlobalConfig.ip_file_owner)
+
     @classmethod
     def execute_cmd(cls, cmd):
         """
@@ -318,48 +1647,134 @@ class EipTools(object):
         return subprocess.getoutput(cmd)
 
     @classmethod
-    def output_excel(cls, tcp_dict, username, is_server_info=None):
-        if os.path.exists(GlobalConfig.excel_path):
-            work_book = openpyxl.load_workbook(GlobalConfig.excel_path)
-        else:
-            work_book = openpyxl.Workbook()
-        if username not in work_book.get_sheet_names():
-            work_book.create_sheet(username)
-        if GlobalConfig.need_delete_sheet_name in work_book.get_sheet_names():
-            need_remove_sheet = work_book.get_sheet_by_name(GlobalConfig.need_delete_sheet_name)
-            work_book.remove_sheet(need_remove_sheet)
-        table = work_book.get_sheet_by_name(username)
-        table.delete_rows(1, 65536)
-        if not is_server_info:
-            table.append(GlobalConfig.excel_title)
-        else:
-            table.append(GlobalConfig.excel_server_info_title)
+    def iter_excel_rows(cls, tcp_dict):
         for ip, eip_info_list in tcp_dict.items():
             for eip_list in eip_info_list:
                 if eip_list:
                     temp_info = [ip]
                     temp_info.extend(eip_list)
-                    table.append(temp_info)
-        work_book.save(GlobalConfig.excel_path)
+                    yield temp_info
 
     @classmethod
-    def request_server(cls, ip, ports):
-        url = r"http://{}:{}/".format(ip, ports)
-        try:
-            ret = requests.get(url, timeout=(180, 180))
-            server_info = ret.headers.get("Server", "Unknown")
-        except Exception as e:
-            print("collect url:{}, err:{}".format(url, e))
-            server_info = str(e)
+    def output_excel(cls, excel_writer, tcp_dict, username, is_server_info=None):
+        if not is_server_info:
+            title = GlobalConfig.excel_title
+        else:
+            title = GlobalConfig.excel_server_info_title
+        excel_writer.add_sheet(username, title, cls.iter_excel_rows(tcp_dict))
+
+    @classmethod
+    def output_port_delta(cls, excel_writer, config_obj, scan_planner, all_port, scan_time):
+        """
+        Diff the open ports of this run against the port snapshot of the last run,
+        add the delta sheet of every account and write the delta json
+        :return: tuple, (port_snapshot, the mask dict to save after the excel is written)
+        """
+        port_snapshot = PortSnapshot(config_obj.get("port_snapshot_path") or GlobalConfig.port_snapshot_path)
+        last_scan_time, last_mask_dict = port_snapshot.load()
+        mask_dict = {ip: PortSnapshot.get_mask(port_list) for ip, port_list in all_port.items()}
+        if last_scan_time is None:
+            print("There is no port snapshot of the last run, skip the delta")
+        else:
+            delta_list = PortSnapshot.diff(last_mask_dict, mask_dict, PortSnapshot.get_high_mask(config_obj))
+            print("Diff with the last run, the count of changed port:{}".format(len(delta_list)))
+            delta_dict = dict()
+            for account in scan_planner.get_owner_list():
+                account_ip_set = set(scan_planner.get_ip_list(account))
+                delta_dict[account] = [delta for delta in delta_list if delta[0] in account_ip_set]
+                excel_writer.add_sheet(account + "_delta", GlobalConfig.excel_delta_title,
+                                       ([ip, port, proto, change, "yes" if is_high_risk else "no"]
+                                        for ip, port, proto, change, is_high_risk in delta_dict[account]))
+            delta_path = config_obj.get("port_delta_path") or GlobalConfig.port_delta_path
+            with open(delta_path, "w", encoding="utf-8") as f:
+                json.dump({
+                    "last_scan_time": last_scan_time,
+                    "scan_time": scan_time,
+                    # opened: the port turns open, closed: the port is no longer open, the other states are ignored
+                    "tracked_state": "open",
+                    "delta": {account: [dict(zip(["ip", "port", "proto", "change", "high_risk"], delta))
+                                        for delta in account_delta_list]
+                              for account, account_delta_list in delta_dict.items()},
+                }, f, indent=2)
+        last_mask_dict.update(mask_dict)
+        return port_snapshot, last_mask_dict
+
+    @classmethod
+    def get_banner_session(cls):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=1, max_retries=0)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.verify = False
+        return session
+
+    @classmethod
+    def request_server(cls, session, ip, ports, config_obj):
+        """
+        Try HEAD before GET and https after http, stop at the first response carrying the Server header
+        :return: string, the Server header, Unknown or the last error
+        """
+        timeout = (config_obj.get("banner_connect_timeout") or GlobalConfig.banner_connect_timeout,
+                   config_obj.get("banner_read_timeout") or GlobalConfig.banner_read_timeout)
+        method_list = ["HEAD", "GET"] if config_obj.get("banner_head_first", GlobalConfig.banner_head_first) else ["GET"]
+        scheme_list = ["http", "https"] if config_obj.get("banner_https_fallback",
+                                                          GlobalConfig.banner_https_fallback) else ["http"]
+        server_info = None
+        for scheme in scheme_list:
+            url = r"{}://{}:{}/".format(scheme, ip, ports)
+            for method in method_list:
+                try:
+                    with session.request(method, url, timeout=timeout, allow_redirects=False, stream=True) as ret:
+                        server_info = ret.headers.get("Server")
+                except requests.exceptions.ConnectTimeout as e:
+                    print("collect url:{}, err:{}".format(url, e))
+                    return str(e)
+                except requests.exceptions.ConnectionError as e:
+                    print("collect url:{}, method:{}, err:{}".format(url, method, e))
+                    # the refused or unreachable port fails the same way over https, the ssl error and the reset do not
+                    if isinstance(getattr(e.args[0] if e.args else None, "reason", None), NewConnectionError):
+                        return str(e)
+                    server_info = server_info or str(e)
+                    break
+                except Exception as e:
+                    print("collect url:{}, method:{}, err:{}".format(url, method, e))
+                    server_info = server_info or str(e)
+                    break
+                if server_info:
+                    return server_info
+                server_info = "Unknown"
         return server_info
 
     @classmethod
-    def collect_tcp_server_info(cls, tcp_ret_dict):
+    def collect_host_server_info(cls, ip, port_list, config_obj):
+        session = cls.get_banner_session()
+        try:
+            return ip, [[port, cls.request_server(session, ip, port, config_obj)] for port in port_list]
+        finally:
+            session.close()
+
+    @classmethod
+    def collect_tcp_server_info(cls, tcp_ret_dict, config_obj=None):
+        """
+        Collect the http server banner of every host on a bounded pool, each host reuses one keep-alive session
+        :return: dict, {ip: [[port, server_info], ...]}
+        """
+        config_obj = config_obj or dict()
+        host_dict = dict()
+        banner_worker = config_obj.get("banner_worker") or GlobalConfig.banner_worker
+        with ThreadPoolExecutor(max_workers=banner_worker) as executor:
+            all_task = list()
+            for ip, ip_info in tcp_ret_dict.items():
+                port_list = [ip_temp[0] for ip_temp in ip_info]
+                if port_list:
+                    all_task.append(executor.submit(cls.collect_host_server_info, ip, port_list, config_obj))
+            for task in as_completed(all_task):
+                ip, server_list = task.result()
+                host_dict[ip] = server_list
         server_dict = defaultdict(list)
-        for ip, ip_info in tcp_ret_dict.items():
-            for ip_temp in ip_info:
-                server_info = cls.request_server(ip, ip_temp[0])
-                server_dict[ip].append([ip_temp[0], server_info])
+        for ip in tcp_ret_dict.keys():
+            if ip in host_dict:
+                server_dict[ip] = host_dict[ip]
         return server_dict
 
 
@@ -373,57 +1788,88 @@ def main():
     else:
         config_path = input_args.config_path
     config_obj = eip_tools.load_yaml(config_path)
-    eip_tools.check_config_data(config_obj)
-    print("############2.start to collect and output to excel######")
-    for config_item in config_obj["account_info"]:
-        result_list = list()
-        ak = config_item["ak"]
-        sk = config_item["sk"]
-        account = config_item["account"]
-        project_info = HuaweiCloud.get_project_zone(ak, sk)
-        if not project_info:
-            print("ak:{}, sk:{} get empty project info.".format(ak[:5], sk[:5]))
-            continue
-        for project_temp in project_info:
-            print("Collect the zone of info:{}".format(project_temp["zone"]))
-            ret_temp = eip_tools.get_data_list(eip_tools, project_temp, ak, sk)
-            result_list.extend(ret_temp or [])
-        result_list = list(set(result_list))
-        print("Write the data to txt, the count of ip:{}...".format(len(result_list)))
-        if not result_list:
-            continue
-        with open("./{}.txt".format(account), "w") as f:
-            f.write("\n".join(result_list))
-        print("###########3.lookup port###################")
-        tcp_ret_dict, udp_ret_dict, all_port = dict(), dict(), dict()
-        for ip in result_list:
-            print("1.start to collect tcp info")
-            eip_tools.execute_cmd(GlobalConfig.tcp_search_cmd.format(ip))
-            tcp_content_list = eip_tools.read_ip_result_txt()
-            print("parse tcp content:{}".format(tcp_content_list))
-            high_port, tcp_port = eip_tools.parse_result_txt(config_obj, tcp_content_list)
-            print("parse tcp port:{}".format(high_port))
-            tcp_ret_dict[ip] = high_port
-            all_port[ip] = tcp_port
-
-            print("2.start to collect udp info")
-            eip_tools.execute_cmd(GlobalConfig.udp_search_cmd.format(ip))
-            udp_content_list = eip_tools.read_ip_result_txt()
-            print("parse udp content:{}".format(udp_content_list))
-            high_port, udp_port = eip_tools.parse_result_txt(config_obj, udp_content_list)
-            print("parse udp port:{}".format(high_port))
-            udp_ret_dict[ip] = high_port
-            all_port[ip].extend(udp_port)
-        print("Write the data to excel, the count of tcp ip:{}...".format(len(tcp_ret_dict.keys())))
-        eip_tools.output_excel(tcp_ret_dict, account + "_tcp")
-        print("Write the data to excel, the count of udp ip:{}...".format(len(udp_ret_dict.keys())))
-        eip_tools.output_excel(udp_ret_dict, account + "_udp")
-        print("Write the data to excel, the count of all ip:{}...".format(len(all_port.keys())))
-        eip_tools.output_excel(all_port, account + "_all_port")
-        print("###########4.query nginx server###################")
-        tcp_server_info = EipTools.collect_tcp_server_info(tcp_ret_dict)
-        eip_tools.output_excel(tcp_server_info, account + "_tcp_server_info", is_server_info=True)
-        print("##################5.finish################")
+    eip_tools.check_config_data(config_obj, input_args.role != "worker")
+    shard_queue = None
+    if input_args.role != "standalone":
+        shard_queue = ShardQueue(input_args.queue_path,
+                                 config_obj.get("queue_lease") or GlobalConfig.queue_lease,
+                                 config_obj.get("queue_poll_interval") or GlobalConfig.queue_poll_interval,
+                                 config_obj.get("queue_stall_timeout") or GlobalConfig.queue_stall_timeout)
+    if input_args.role == "worker":
+        print("##################2.start to work on the shard queue#############")
+        eip_tools.run_queue_worker_pool(config_obj, shard_queue)
+        print("##################3.finish################")
+        return
+    project_cache_ttl = config_obj.get("project_cache_ttl", GlobalConfig.project_cache_ttl)
+    project_cache = ProjectCache(GlobalConfig.project_cache_path, project_cache_ttl) if project_cache_ttl else None
+    excel_writer = ExcelWriter(GlobalConfig.excel_path)
+    scan_state = None
+    if config_obj.get("incremental_scan"):
+        rescan_window_days = config_obj.get("rescan_window_days") or GlobalConfig.rescan_window_days
+        scan_state = ScanState(GlobalConfig.scan_state_path, rescan_window_days)
+    scan_journal = ScanJournal(GlobalConfig.scan_journal_path)
+    if input_args.resume:
+        scan_journal.load()
+    else:
+        scan_journal.clear()
+    scan_planner = ScanPlanner()
+    stage_timer = StageTimer()
+    print("############2.start to collect the ip of all accounts######")
+    with stage_timer.stage("discovery"):
+        eip_tools.collect_account_ip(eip_tools, config_obj, scan_planner, project_cache, input_args)
+    result_list = scan_planner.ip_list
+    print("The count of deduplicated ip of all accounts:{}".format(len(result_list)))
+    print("###########3.lookup port###################")
+    if scan_state is not None:
+        tcp_ret_dict, udp_ret_dict, all_port = eip_tools.incremental_scan_ip_list(config_obj, result_list,
+                                                                                  scan_state, scan_journal,
+                                                                                  shard_queue, stage_timer)
+        scan_state.save()
+    else:
+        tcp_ret_dict, udp_ret_dict, all_port = eip_tools.scan_ip_list(config_obj, result_list, scan_journal,
+                                                                      shard_queue, stage_timer)
+    print("###########4.query nginx server###################")
+    with stage_timer.stage("banner"):
+        tcp_server_info = EipTools.collect_tcp_server_info(tcp_ret_dict, config_obj)
+    with stage_timer.stage("excel"):
+        for account in scan_planner.get_owner_list():
+            account_tcp_dict = scan_planner.split_result(tcp_ret_dict, account)
+            print("Write the data to excel, the count of tcp ip:{}...".format(len(account_tcp_dict.keys())))
+            eip_tools.output_excel(excel_writer, account_tcp_dict, account + "_tcp")
+            account_udp_dict = scan_planner.split_result(udp_ret_dict, account)
+            print("Write the data to excel, the count of udp ip:{}...".format(len(account_udp_dict.keys())))
+            eip_tools.output_excel(excel_writer, account_udp_dict, account + "_udp")
+            account_all_port = scan_planner.split_result(all_port, account)
+            print("Write the data to excel, the count of all ip:{}...".format(len(account_all_port.keys())))
+            eip_tools.output_excel(excel_writer, account_all_port, account + "_all_port")
+            account_server_info = scan_planner.split_result(tcp_server_info, account)
+            eip_tools.output_excel(excel_writer, account_server_info, account + "_tcp_server_info",
+                                   is_server_info=True)
+        port_snapshot = None
+        if config_obj.get("port_delta", GlobalConfig.port_delta):
+            port_snapshot, mask_dict = eip_tools.output_port_delta(excel_writer, config_obj, scan_planner, all_port,
+                                                                   int(time.time()))
+        print("Write the excel:{}...".format(GlobalConfig.excel_path))
+        excel_writer.save()
+        if port_snapshot is not None:
+            port_snapshot.save(int(time.time()), mask_dict)
+    if config_obj.get("scan_history", GlobalConfig.scan_history):
+        with stage_timer.stage("history"):
+            scan_history = ScanHistory(config_obj.get("scan_history_path") or GlobalConfig.scan_history_path)
+            scan_time = int(time.time())
+            history_port = all_port
+            if scan_state is not None:
+                # the cached result of the ip not rescanned is already in the history of the run scanning it
+                history_port = {ip: port_list for ip, port_list in all_port.items() if ip in scan_state.scanned_ip_set}
+            row_count = 0
+            for account in scan_planner.get_owner_list():
+                row_count += scan_history.append(scan_time, account, scan_planner.split_result(history_port, account),
+                                                 scan_planner.split_result(tcp_server_info, account))
+            print("Append the result to the scan history:{}, the count of row:{}".format(scan_history.path,
+                                                                                         row_count))
+    scan_journal.clear()
+    stage_timer.output(input_args.stage_report)
+    print("##################5.finish################")
 
 
 if __name__ == "__main__":